@@ -2,19 +2,120 @@
 # Cura is released under the terms of the LGPLv3 or higher.
 from copy import deepcopy
 from datetime import datetime, timezone
-from typing import TypeVar, Dict, List, Any, Type, Union
+import logging
+from typing import TypeVar, Dict, List, Any, Type, Union, Callable, Optional, get_type_hints
 
 
 # Type variable used in the parse methods below, which should be a subclass of BaseModel.
 T = TypeVar("T", bound="BaseModel")
 
+# Field types that are serialized as they are.
+SCALAR_TYPES = (str, int, float, bool, type(None))
+
+
+## Serializers for a single kind of field, as used by the models with __slots__. Each one converts value and returns
+#  previous instead if the result is the same.
+def _serializeScalar(value: Any, previous: Any) -> Any:
+    # Don't mix up e.g. 1 and True
+    if type(previous) is type(value) and previous == value:
+        return previous
+    return value
+
+
+def _serializeModel(value: Optional["BaseModel"], previous: Any) -> Any:
+    return None if value is None else value.serialize()
+
+
+def _serializeModels(value: Optional[List["BaseModel"]], previous: Any) -> Any:
+    if value is None:
+        return None
+    items = [None if model is None else model.serialize() for model in value]
+    if isinstance(previous, list) and len(previous) == len(items) and all(
+            a is b for a, b in zip(items, previous)):
+        return previous
+    return items
+
 
 class BaseModel:
 
+    # Internal state of serialize(). Subclasses that declare __slots__ for all of their fields store no __dict__ and
+    # get a serializer for each field, chosen once by the type hints of __init__. See __init_subclass__().
+    __slots__ = ("_serialized", "_dirty", "_nested")
+
+    # Serializers by field name, None for models that store their fields in __dict__.
+    _serializers = None  # type: Optional[Dict[str, Callable[[Any, Any], Any]]]
+    # Fields that can change without an assignment, i.e. submodels, lists and dictionaries.
+    _nested_fields = frozenset()
+
+    def __new__(cls, *args, **kwargs):
+        self = super().__new__(cls)
+        object.__setattr__(self, "_serialized", None)
+        return self
+
+    ## Sets the remaining fields, e.g. ones that a newer API added. Models with __slots__ have no room for fields
+    #  they don't declare, so these are logged and dropped.
     def __init__(self, **kwargs) -> None:
-        self.__dict__.update(kwargs)
+        for name, value in kwargs.items():
+            if self._serializers is None or name in self._serializers:
+                setattr(self, name, value)
+            else:
+                logging.debug("Ignoring unknown field %s of %s", name, type(self).__name__)
         self.validate()
 
+    ## Generates the serializers of a model class with __slots__.
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        classes = cls.__mro__[:-1]  # Without object
+        if not all("__slots__" in vars(c) for c in classes):
+            cls._serializers = None
+            cls._nested_fields = frozenset()
+            return
+        # In the order of assignment in __init__, which calls super().__init__() last
+        fields = [name for c in classes for name in c.__slots__ if name[0] != "_"]
+        hints = {}  # type: Dict[str, Any]
+        for c in reversed(classes):
+            if "__init__" in vars(c):
+                hints.update(get_type_hints(c.__init__))
+        cls._serializers = {name: cls._fieldSerializer(hints.get(name, Any)) for name in fields}
+        cls._nested_fields = frozenset(name for name, serializer in cls._serializers.items()
+                                       if serializer is not _serializeScalar)
+
+    ## Chooses the serializer for a field.
+    #  \param hint: The type hint of the field.
+    #  \return One of the _serialize* functions.
+    @classmethod
+    def _fieldSerializer(cls, hint: Any) -> Callable[[Any, Any], Any]:
+        def union(t):
+            return t.__args__ if getattr(t, "__origin__", None) is Union else (t,)
+
+        def is_model(t):
+            return isinstance(t, type) and issubclass(t, BaseModel)
+
+        types = union(hint)
+        if all(t in SCALAR_TYPES for t in types):
+            return _serializeScalar
+        if any(is_model(t) for t in types):
+            return _serializeModel
+        for t in types:
+            if getattr(t, "__origin__", None) is list and any(is_model(i) for i in union(t.__args__[0])):
+                return _serializeModels
+        return cls._serializeValue
+
+    ## Sets an attribute and remembers that it needs to be serialized again.
+    #  Attributes starting with an underscore are internal and not serialized.
+    def __setattr__(self, name: str, value: Any) -> None:
+        object.__setattr__(self, name, value)
+        if name[0] != "_" and self._serialized is not None:
+            self._dirty.add(name)
+
+    ## Pickles only the fields, e.g. for models that are created in the printer process.
+    def __getstate__(self) -> Dict[str, Any]:
+        return self.toDict()
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        for name, value in state.items():
+            setattr(self, name, value)
+
     # Validates the model, raising an exception if the model is invalid.
     def validate(self) -> None:
         pass
@@ -33,31 +134,75 @@ class BaseModel:
 
     ## Converts the model into a serializable dictionary
     def toDict(self) -> Dict[str, Any]:
-        return self.__dict__
+        if self._serializers is None:
+            return {k: v for k, v in self.__dict__.items() if k[0] != "_"}
+        return {name: getattr(self, name) for name in self._serializers if hasattr(self, name)}
 
     ## Convert model and recursively all submodels into a dictionary
+    #  The result is cached and only the attributes that were assigned since the last call are converted again,
+    #  together with submodels, lists and dictionaries, which might have changed in place. If nothing changed, the
+    #  same dictionary is returned again, so it must not be modified.
     def serialize(self) -> Dict[str, Any]:
-        # deepcopy to not mutate the object
-        dictionary = deepcopy(self.toDict())
-        to_remove = [] # None-values that will be removed
-        for k, v in dictionary.items():
-            if v is None:
-                to_remove.append(k)
-            # Serialize recursively if we encounter another Model
-            elif isinstance(v, BaseModel): # Gets all Models
-                dictionary[k] = v.serialize()
-            # It could also be a list of models
-            elif isinstance(v, list):
-                for i, m in enumerate(v):
-                    if isinstance(m, BaseModel):
-                        v[i] = m.serialize()
-            # Some models store datetime objects
-            elif isinstance(v, datetime):
-                # Replace with date string as parsed by self.parseDate()
-                dictionary[k] = v.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-        for k in to_remove:
-            del dictionary[k]
-        return dictionary
+        previous = self._serialized
+        serializers = self._serializers
+        if previous is None:
+            keys = self.toDict().keys()
+            result = {}
+            nested = set() if serializers is None else self._nested_fields
+        else:
+            keys = self._dirty | self._nested
+            result = previous
+            nested = self._nested
+        for k in keys:
+            value = getattr(self, k, None)
+            old = None if previous is None else previous.get(k)
+            if serializers is None:
+                new = self._serializeValue(value, old)
+                if isinstance(value, (BaseModel, list, dict)):
+                    nested.add(k)
+                else:
+                    nested.discard(k)
+            else:
+                new = serializers[k](value, old)
+            if new is old:
+                continue
+            if result is previous:
+                result = dict(previous)
+            if new is None:
+                result.pop(k, None)
+            else:
+                result[k] = new
+        if previous is None:
+            object.__setattr__(self, "_dirty", set())
+            object.__setattr__(self, "_nested", nested)
+        else:
+            self._dirty.clear()
+        object.__setattr__(self, "_serialized", result)
+        return result
+
+    ## Converts a single value for serialize(), reusing the previous result if it didn't change.
+    #  \param value: The value to convert.
+    #  \param previous: The result of the last conversion of the value or None.
+    #  \return The converted value, which is previous if it is the same.
+    @classmethod
+    def _serializeValue(cls, value: Any, previous: Any) -> Any:
+        if value is None:
+            return None
+        if isinstance(value, BaseModel):
+            return value.serialize()
+        if isinstance(value, list):
+            old_items = previous if isinstance(previous, list) and len(previous) == len(value) else None
+            items = [cls._serializeValue(v, None if old_items is None else old_items[i])
+                     for i, v in enumerate(value)]
+            if old_items is not None and all(a is b for a, b in zip(items, old_items)):
+                return previous
+            return items
+        if isinstance(value, datetime):
+            # Replace with date string as parsed by self.parseDate()
+            value = value.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        elif isinstance(value, dict):
+            return previous if previous == value else deepcopy(value)
+        return _serializeScalar(value, previous)
 
     ## Parses a single model.
     #  \param model_class: The model class.
@@ -5,6 +5,7 @@ from ..BaseModel import BaseModel
 
 ## Class representing a cluster printer
 class ClusterBuildPlate(BaseModel):
+    __slots__ = ("type",)
 
     ## Create a new build plate
     #  \param type: The type of build plate glass or aluminium
@@ -9,6 +9,7 @@ from ..BaseModel import BaseModel
 ## Class representing a cloud cluster printer configuration
 #  Also used for representing slots in a Material Station (as from Cura's perspective these are the same).
 class ClusterPrintCoreConfiguration(BaseModel):
+    __slots__ = ("extruder_index", "material", "print_core_id")
 
     ## Creates a new cloud cluster printer configuration object
     #  \param extruder_index: The position of the extruder on the machine as list index. Numbered from left to right.
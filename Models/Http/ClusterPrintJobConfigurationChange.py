@@ -7,6 +7,7 @@ from ..BaseModel import BaseModel
 
 ## Model for the types of changes that are needed before a print job can start
 class ClusterPrintJobConfigurationChange(BaseModel):
+    __slots__ = ("type_of_change", "index", "target_id", "origin_id", "target_name", "origin_name")
 
     ## Creates a new print job constraint.
     #  \param type_of_change: The type of configuration change, one of: "material", "print_core_change"
@@ -7,6 +7,7 @@ from ..BaseModel import BaseModel
 
 ## Class representing a cloud cluster print job constraint
 class ClusterPrintJobConstraints(BaseModel):
+    __slots__ = ("require_printer_name",)
 
     ## Creates a new print job constraint.
     #  \param require_printer_name: Unique name of the printer that this job should be printed on.
@@ -12,6 +12,12 @@ from ..BaseModel import BaseModel
 
 ## Model for the status of a single print job in a cluster.
 class ClusterPrintJobStatus(BaseModel):
+    __slots__ = (
+        "assigned_to", "configuration", "constraints", "created_at", "force", "last_seen", "machine_variant", "name",
+        "network_error_count", "owner", "printer_uuid", "started", "status", "time_elapsed", "time_total", "uuid",
+        "deleted_at", "printed_on_uuid", "configuration_changes_required", "build_plate",
+        "compatible_machine_families", "impediments_to_printing"
+    )
 
     ## Creates a new cloud print job status model.
     #  \param assigned_to: The name of the printer this job is assigned to while being queued.
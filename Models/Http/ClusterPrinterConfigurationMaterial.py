@@ -8,6 +8,7 @@ from ..BaseModel import BaseModel
 
 ## Class representing a cloud cluster printer configuration
 class ClusterPrinterConfigurationMaterial(BaseModel):
+    __slots__ = ("guid", "brand", "color", "material")
 
     ## Creates a new material configuration model.
     #  \param brand: The brand of material in this print core, e.g. 'Ultimaker'.
@@ -8,6 +8,7 @@ from .ClusterPrinterMaterialStationSlot import ClusterPrinterMaterialStationSlot
 
 ## Class representing the data of a Material Station in the cluster.
 class ClusterPrinterMaterialStation(BaseModel):
+    __slots__ = ("status", "supported", "material_slots")
 
     ## Creates a new Material Station status.
     #  \param status: The status of the material station.
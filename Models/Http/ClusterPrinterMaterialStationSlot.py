@@ -7,6 +7,7 @@ from .ClusterPrintCoreConfiguration import ClusterPrintCoreConfiguration
 
 ##  Class representing the data of a single slot in the material station.
 class ClusterPrinterMaterialStationSlot(ClusterPrintCoreConfiguration):
+    __slots__ = ("slot_index", "compatible", "material_remaining", "material_empty")
     
     ## Create a new material station slot object.
     #  \param slot_index: The index of the slot in the material station (ranging 0 to 5).
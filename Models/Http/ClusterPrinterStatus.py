@@ -12,6 +12,11 @@ from ..BaseModel import BaseModel
 
 ##  Class representing a cluster printer
 class ClusterPrinterStatus(BaseModel):
+    __slots__ = (
+        "configuration", "enabled", "firmware_version", "friendly_name", "ip_address", "machine_variant", "status",
+        "unique_name", "uuid", "reserved_by", "maintenance_required", "firmware_update_status",
+        "latest_available_firmware", "build_plate", "material_station"
+    )
 
     ## Creates a new cluster printer status
     #  \param enabled: A printer can be disabled if it should not receive new jobs. By default every printer is enabled.
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Execute to benchmark performance critical parts of the module.
+
+    ./benchmark.py mimeparser [SIZE_MB]
+    ./benchmark.py models [JOBS]
+    ./benchmark.py routing [REQUESTS]
+"""
+
+import argparse
+import io
+import os
+import site
+import tempfile
+import time
+import tracemalloc
+site.addsitedir(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from klipper_cura_connection.mimeparser import MimeParser
+from klipper_cura_connection.Models.Http.ClusterPrintCoreConfiguration import (
+        ClusterPrintCoreConfiguration)
+from klipper_cura_connection.Models.Http.ClusterPrintJobStatus import (
+        ClusterPrintJobStatus)
+from klipper_cura_connection.server import CLUSTER_API, router
+
+
+def bench_mimeparser(args):
+    """Parse an upload of a G-Code file and report the throughput"""
+    line = b"G1 X100.123 Y100.456 E0.12345 F1800\n"
+    data = line * (args.size * 1024 * 1024 // len(line))
+    boundary = "BenchmarkBoundary"
+    body = (b"--" + boundary.encode() + b"\r\n"
+            + b'Content-Disposition: form-data; name="owner"\r\n\r\n'
+            + b"benchmark\r\n"
+            + b"--" + boundary.encode() + b"\r\n"
+            + b'Content-Disposition: form-data; name="file"; '
+            + b'filename="benchmark.gcode"\r\n\r\n'
+            + data + b"\r\n"
+            + b"--" + boundary.encode() + b"--\r\n")
+    with tempfile.TemporaryDirectory() as out_dir:
+        times = []
+        for _ in range(args.repeat):
+            fp = io.BufferedReader(io.BytesIO(body))
+            start = time.perf_counter()
+            MimeParser(fp, boundary, len(body), out_dir).parse()
+            times.append(time.perf_counter() - start)
+    best = min(times)
+    print("MimeParser: {} MB in {:.3f}s (best of {}): {:.1f} MB/s".format(
+        args.size, best, args.repeat, len(body) / best / 1e6))
+
+
+def create_print_job(i):
+    """A print job model like ContentManager.create_cluster_print_job()"""
+    configuration = [ClusterPrintCoreConfiguration(
+        extruder_index=0,
+        material={
+            "guid": "506c9f0d-e3aa-4bd4-b2d2-23e2425b1aa9",
+            "brand": "Generic",
+            "color": "Red",
+            "material": "PLA",
+        },
+        print_core_id="AA 0.4",
+    )]
+    return ClusterPrintJobStatus(
+        created_at="2021-01-01T00:00:00.000000Z",
+        force=False,
+        machine_variant="Ultimaker 3",
+        name="job{}.gcode".format(i),
+        started=False,
+        status="queued",
+        time_total=3600,
+        time_elapsed=0,
+        uuid="00000000-0000-0000-0000-{:012d}".format(i),
+        configuration=configuration,
+        constraints=[],
+    )
+
+
+def bench_models(args):
+    """Measure memory and serialize() time of print job models"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    jobs = [create_print_job(i) for i in range(args.jobs)]
+    memory = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print("Memory: {:.0f} bytes per job".format(memory / args.jobs))
+
+    def timed(prepare):
+        times = []
+        for _ in range(args.repeat):
+            prepare()
+            start = time.perf_counter()
+            for job in jobs:
+                job.serialize()
+            times.append(time.perf_counter() - start)
+        return min(times) / args.jobs * 1e6
+
+    def fresh():
+        jobs[:] = [create_print_job(i) for i in range(args.jobs)]
+    def progress():
+        for job in jobs:
+            job.time_elapsed += 1
+    print("serialize() new job:       {:6.2f} us".format(timed(fresh)))
+    print("serialize() unchanged:     {:6.2f} us".format(timed(lambda: None)))
+    print("serialize() time_elapsed:  {:6.2f} us".format(timed(progress)))
+
+
+def bench_routing(args):
+    """Measure the time to find the handler of a request"""
+    uuid = "01234567-89ab-cdef-0123-456789abcdef"
+    requests = [
+        ("GET", CLUSTER_API + "printers"),
+        ("GET", CLUSTER_API + "print_jobs"),
+        ("GET", CLUSTER_API + "print_jobs/" + uuid + "/preview_image"),
+        ("PUT", CLUSTER_API + "print_jobs/" + uuid + "/action"),
+        ("DELETE", CLUSTER_API + "print_jobs/" + uuid),
+        ("GET", "/favicon.ico"),
+    ]
+    for method, path in requests:
+        times = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            for _ in range(args.requests):
+                router.resolve(method, path)
+            times.append(time.perf_counter() - start)
+        print("{:6} {:78} {:6.0f} ns".format(method, path,
+            min(times) / args.requests * 1e9))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=3,
+            help="Number of runs, the best one is reported")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    mime = subparsers.add_parser("mimeparser", help=bench_mimeparser.__doc__)
+    mime.add_argument("size", type=int, nargs="?", default=100,
+            help="Size of the uploaded file in MB")
+    mime.set_defaults(func=bench_mimeparser)
+    models = subparsers.add_parser("models", help=bench_models.__doc__)
+    models.add_argument("jobs", type=int, nargs="?", default=1000,
+            help="Number of print jobs")
+    models.set_defaults(func=bench_models)
+    routing = subparsers.add_parser("routing", help=bench_routing.__doc__)
+    routing.add_argument("requests", type=int, nargs="?", default=100000,
+            help="Number of lookups per path")
+    routing.set_defaults(func=bench_routing)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,10 @@
+from collections import namedtuple
 from datetime import datetime
+from types import MappingProxyType
+import json
 import os
+import threading
+import time
 import uuid as uuid_lib
 
 from .Models.Http.ClusterMaterial import ClusterMaterial
@@ -7,10 +12,46 @@ from .Models.Http.ClusterPrintCoreConfiguration import (
         ClusterPrintCoreConfiguration)
 from .Models.Http.ClusterPrinterStatus import ClusterPrinterStatus
 from .Models.Http.ClusterPrintJobStatus import ClusterPrintJobStatus
+from .eventstream import EventStream
+from .jobjournal import JobJournal
+from .metadatacache import MetadataCache
+from .reactorbridge import ReactorTimeout
+from .singleflight import SingleFlight
+from .statuscollector import StatusCollector
+
+# State as published by ContentManager.update().  printers and print_jobs
+# are Resources.  time is the reactor-independent time.monotonic() of
+# the update.  jobs is a tuple of the JobRefs of all print jobs in queue
+# order and jobs_by_uuid a read-only mapping of the same JobRefs by the
+# uuid known to Cura.  Snapshots are never modified, so everything taken
+# from one snapshot (e.g. the index of a job) stays consistent.
+Snapshot = namedtuple("Snapshot", ["version", "time", "printers",
+    "print_jobs", "jobs", "jobs_by_uuid", "printing"])
+
+# A print job in the queue.  klippy_uuid is the uuid of the job in
+# virtual_sdcard, which is needed for all queue operations.
+JobRef = namedtuple("JobRef", ["index", "uuid", "klippy_uuid", "path",
+    "name"])
+
+# JSON encoded content of an API response.  The generation is only
+# increased when the encoded content changes, so the ETag is too.
+Resource = namedtuple("Resource", ["generation", "etag", "body"])
 
 
 class ContentManager:
 
+    # Snapshots older than this many seconds are still served, but a new
+    # one is fetched in the background
+    SNAPSHOT_MAX_AGE = 4
+    # Snapshots older than this are not served at all.  Requests then
+    # wait up to STALE_WAIT seconds for a newer one, and fail otherwise.
+    SNAPSHOT_MAX_STALENESS = 30
+    STALE_WAIT = 2
+    # Seconds for which a preview image is reused for further requests
+    PREVIEW_MAX_AGE = 10
+    # Seconds to wait for klippy during an update
+    UPDATE_TIMEOUT = 5
+
     def __init__(self, module):
         self.module = module
         self.reactor = module.reactor
@@ -26,11 +67,55 @@ class ContentManager:
             uuid=self.new_uuid(),
             configuration=[],
         )
+        self.loaded_materials = None # As returned by obtain_loaded_material()
         self.klippy_jobs = []
         self.print_jobs = [] # type: [ClusterPrintJobStatus]
+        # Lists of print jobs by path, kept in sync with print_jobs by
+        # update_print_jobs().  Requests look print jobs up by uuid in
+        # the snapshot instead.
+        self.print_jobs_by_path = {}
+        # The uuids of print jobs can differ from the uuids of the
+        # klippy jobs in the queue when they were restored by the journal
+        self.print_jobs_by_klippy_uuid = {}
+        self.klippy_uuids = {} # klippy uuid by print job uuid
+        self.journal = JobJournal(
+                os.path.join(self.module.CACHE_PATH, "jobs.journal"))
+        # Lists of the owners of uploaded files not yet in the queue, by path
+        self.owners = {}
+        # Metadata of uploaded files, by path. See add_upload()
+        self.uploads = {}
+        self.thumbnail_dir = os.path.join(self.module.CACHE_PATH, "thumbnails")
+        os.makedirs(self.thumbnail_dir, exist_ok=True)
+        self.metadata_cache = MetadataCache(
+                os.path.join(self.module.CACHE_PATH, "metadata.json"))
         # type: [ClusterMaterial]
         self.materials = self.reactor.cb(self.obtain_material, process='printer', wait=True)
 
+        # The prefix keeps ETags from matching across restarts
+        self._etag_prefix = uuid_lib.uuid4().hex[:8]
+        self._generation = 0
+        self.materials_resource = self.encode(
+                [m.serialize() for m in self.materials])
+        self.snapshot = Snapshot(0, time.monotonic(),
+                self.encode([self.printer_status.serialize()]),
+                self.encode([]), (), MappingProxyType({}), False)
+        self._published = threading.Condition()
+        # Serialized models of the last snapshot, to find changes
+        self._published_printer = self.printer_status.serialize()
+        self._published_jobs = []
+        self.events = EventStream()
+        self.flights = SingleFlight()
+        self.collector = StatusCollector(self)
+
+    def start(self):
+        """Start collecting the printer status in the background"""
+        self.collector.start()
+
+    def stop(self):
+        self.collector.stop()
+        self.events.close()
+        self.journal.close()
+
     @staticmethod
     def obtain_material(e, printer):
         """
@@ -44,22 +129,36 @@ class ContentManager:
                 for guid in fm.guid_to_path]
 
     def create_cluster_print_job(self, klippy_pj):
-        """Return a print job model for the given path"""
-        md = self.module.metadata.get_metadata(klippy_pj.path)
-        configuration = []
-        for i in range(md.get_extruder_count()):
-            configuration.append(ClusterPrintCoreConfiguration(
-                extruder_index=i,
-                material={
-                    "guid": md.get_material_guid(i),
-                    "brand": md.get_material_brand(i),
-                    "color": md.get_material_info("./m:metadata/m:name/m:color", i),
-                    "material": md.get_material_type(i),
-                },
-                print_core_id="AA 0.4",
-            ))
+        """
+        Return a print job model for the given klippy job.  Jobs that
+        were in the queue before a restart keep their uuid, creation
+        time and owner, as stored in the journal.  Fresh uploads are
+        never matched to journal entries of the same file.
+        """
+        materials, time_total = self.get_job_metadata(klippy_pj.path)
+        owner = None
+        uploaded = klippy_pj.path in self.owners
+        if uploaded:
+            owner = self.owners[klippy_pj.path].pop(0)
+            if not self.owners[klippy_pj.path]:
+                del self.owners[klippy_pj.path]
+        configuration = [ClusterPrintCoreConfiguration(
+            extruder_index=i,
+            material=material,
+            print_core_id="AA 0.4",
+        ) for i, material in enumerate(materials)]
+        entry = self.journal.claim(klippy_pj.uuid, klippy_pj.path,
+                match_file=not uploaded)
+        if entry is not None:
+            uuid, created_at = entry["uuid"], entry["created_at"]
+            if not uploaded:
+                owner = entry["owner"]
+        else:
+            uuid, created_at = klippy_pj.uuid, self.get_time_str()
+            self.journal.add(uuid, klippy_pj.uuid, klippy_pj.path,
+                    created_at, owner)
         return ClusterPrintJobStatus(
-            created_at=self.get_time_str(),
+            created_at=created_at,
             force=False,
             machine_variant="Ultimaker 3",
             name=os.path.basename(klippy_pj.path),
@@ -68,19 +167,135 @@ class ContentManager:
             # pausing, paused, resuming, queued, printing, post_print
             # (possibly also aborted and aborting)
             status="queued",
-            time_total=md.get_time() or 0,
+            time_total=time_total or 0,
             time_elapsed=0,
-            uuid=klippy_pj.uuid,
+            uuid=uuid,
+            owner=owner,
             configuration=configuration,
             constraints=[],
         )
 
+    def get_job_metadata(self, path):
+        """
+        Return a list with a material dictionary for every extruder and
+        the estimated print time of the G-Code file at path.
+        For uploaded files this uses what was scanned during the upload,
+        other files are read by gcode_metadata.  The result is stored in
+        the metadata cache, which is used instead if possible.
+        """
+        upload = self.uploads.get(path)
+        if upload is not None:
+            guids, time_total, thumbnail = upload
+            materials = self.module.reactor_bridge.call(
+                    self.obtain_material_info, guids,
+                    timeout=self.UPDATE_TIMEOUT)
+            self.metadata_cache.put(path, materials, time_total, thumbnail)
+            # Not before, so that it is still there after a ReactorTimeout
+            self.uploads.pop(path, None)
+            return materials, time_total
+        cached = self.metadata_cache.get(path)
+        if cached is not None:
+            return cached["materials"], cached["time"]
+        md = self.module.metadata.get_metadata(path)
+        materials = [{
+            "guid": md.get_material_guid(i),
+            "brand": md.get_material_brand(i),
+            "color": md.get_material_info("./m:metadata/m:name/m:color", i),
+            "material": md.get_material_type(i),
+        } for i in range(md.get_extruder_count())]
+        time_total = md.get_time()
+        self.metadata_cache.put(path, materials, time_total,
+                md.get_thumbnail_path())
+        return materials, time_total
+
+    def get_preview_image(self, job):
+        """
+        Return the PNG data of the preview image of the JobRef job.
+        Concurrent requests for the same print job share one read.
+        """
+        return self.flights.do(("preview", job.uuid),
+                self._read_preview_image, job.path,
+                max_age=self.PREVIEW_MAX_AGE)
+
+    def _read_preview_image(self, path):
+        with open(self.module.get_thumbnail_path(path), "rb") as fp:
+            return fp.read()
+
+    def get_thumbnail_path(self, path):
+        """
+        Return the path of the thumbnail of the G-Code file at path or
+        None.  Uses the metadata cache if possible.
+        """
+        cached = self.metadata_cache.get(path)
+        # Thumbnails of gcode_metadata might have been cleaned up
+        if cached is not None and (cached["thumbnail"] is None
+                or os.path.exists(cached["thumbnail"])):
+            return cached["thumbnail"]
+        upload = self.uploads.get(path)
+        if upload is not None:
+            return upload[2]
+        return self.module.metadata.get_metadata(path).get_thumbnail_path()
+
+    @staticmethod
+    def obtain_material_info(e, printer, guids):
+        """Look up brand, color and type of the materials with guids"""
+        fm = printer.objects['filament_manager']
+        materials = []
+        for guid in guids:
+            if guid:
+                materials.append({
+                    'guid': guid,
+                    'brand': fm.get_info(guid, "./m:metadata/m:name/m:brand"),
+                    'color': fm.get_info(guid, "./m:metadata/m:name/m:color"),
+                    'material': fm.get_info(guid, "./m:metadata/m:name/m:material")})
+            else:
+                materials.append({
+                    'guid': None, 'brand': None, 'color': None, 'material': None})
+        return materials
+
+    def add_upload(self, path, scanner, owner=None):
+        """
+        Keep the metadata that a HeaderScanner found while the file at
+        path was uploaded and the name of the user that uploaded it,
+        until the print job gets created.
+        """
+        # The same file can be uploaded (and queued) multiple times
+        self.owners.setdefault(path, []).append(owner)
+        thumbnail_path = None
+        if scanner.thumbnail:
+            thumbnail_path = os.path.join(self.thumbnail_dir,
+                    os.path.basename(path) + ".png")
+            with open(thumbnail_path, "wb") as fp:
+                fp.write(scanner.thumbnail)
+        self.uploads[path] = (scanner.material_guids or [None], scanner.time,
+                thumbnail_path)
+
+    def remove_upload(self, path):
+        """Forget everything about an uploaded file that was deleted"""
+        thumbnail_paths = set()
+        upload = self.uploads.pop(path, None)
+        if upload is not None:
+            thumbnail_paths.add(upload[2])
+        cached = self.metadata_cache.pop(path)
+        if cached is not None:
+            thumbnail_paths.add(cached["thumbnail"])
+        self.metadata_cache.save()
+        for thumbnail_path in thumbnail_paths:
+            # Only remove our own thumbnails
+            if (thumbnail_path and os.path.dirname(thumbnail_path)
+                    == self.thumbnail_dir):
+                try:
+                    os.remove(thumbnail_path)
+                except OSError:
+                    pass
+
     def add_test_print(self, path):
         """
         Testing only: add a print job outside of klipper and pretend
         we're printing.
         """
-        self.print_jobs.append(self.create_cluster_print_job(path))
+        print_job = self.create_cluster_print_job(path)
+        self.print_jobs.append(print_job)
         self.print_jobs[0].status = "printing"
         self.print_jobs[0].started = True
         self.print_jobs[0].time_total = 10000
@@ -105,20 +320,150 @@ class ContentManager:
                 materials.append(None)
         return materials
 
+    @staticmethod
+    def obtain_print_jobs(e, printer):
+        return printer.objects['virtual_sdcard'].get_status()['jobs']
+
+    @staticmethod
+    def obtain_remaining_time(e, printer):
+        return printer.objects['print_stats'].get_print_time_prediction()[0]
+
     @classmethod
-    def obtain_material_printjobs(cls, e, printer):
+    def obtain_status(cls, e, printer):
+        """Everything needed for an update in a single reactor callback"""
         materials = cls.obtain_loaded_material(e, printer)
         printjobs = cls.obtain_print_jobs(e, printer)
-        return materials, printjobs
+        remaining = cls.obtain_remaining_time(e, printer)
+        return materials, printjobs, remaining
+
+    def update(self):
+        """
+        Fetch the current state from klippy, apply it to the models and
+        publish a new snapshot.  Only called by the StatusCollector
+        thread, requests wake it up with refresh().
+        """
+        materials, klippy_jobs, remaining = self.module.reactor_bridge.call(
+                self.obtain_status, timeout=self.UPDATE_TIMEOUT)
+        self.update_printers(materials, klippy_jobs)
+        if not self.module.testing:
+            self.update_print_jobs(klippy_jobs, remaining)
+        previous = self.snapshot
+        jobs = tuple(JobRef(i, print_job.uuid, klippy_job.uuid,
+                            klippy_job.path, print_job.name)
+                for i, (print_job, klippy_job)
+                in enumerate(zip(self.print_jobs, self.klippy_jobs)))
+        printer = self.printer_status.serialize()
+        print_jobs = [m.serialize() for m in self.print_jobs]
+        snapshot = Snapshot(previous.version + 1, time.monotonic(),
+                self.encode([printer], previous.printers),
+                self.encode(print_jobs, previous.print_jobs),
+                jobs, MappingProxyType({job.uuid: job for job in jobs}),
+                self.printer_status.status == "printing")
+        events = self.find_changes(self._published_printer, printer,
+                self._published_jobs, print_jobs)
+        self._published_printer = printer
+        self._published_jobs = print_jobs
+        # Publish by replacing the reference, readers never need a lock
+        # unless they wait for a newer snapshot
+        with self._published:
+            self.snapshot = snapshot
+            self._published.notify_all()
+        if events or previous.version == 0:
+            self.events.publish(events,
+                    b'{"printers":' + snapshot.printers.body
+                    + b',"print_jobs":' + snapshot.print_jobs.body + b"}")
+
+    @staticmethod
+    def _changed_fields(old, new):
+        """Return the changed fields of new, removed ones as None"""
+        changes = {k: v for k, v in new.items()
+                   if k not in old or (old[k] is not v and old[k] != v)}
+        changes.update((k, None) for k in old.keys() - new.keys())
+        return changes
+
+    def find_changes(self, old_printer, printer, old_jobs, print_jobs):
+        """
+        Return the events for the EventStream between two states, given
+        as serialized printer and list of serialized print jobs:
+
+        printer         {field: value} of the changed printer fields
+        job_added       The serialized new print job
+        job_changed     {"uuid": uuid, "changes": {field: value}}, e.g.
+                        a status transition or the progress of a print
+        job_removed     {"uuid": uuid}
+        queue           {"order": [uuid, ...]} if the order changed
+
+        Unchanged models serialize to the same object, so only changed
+        ones are compared field by field.
+        """
+        events = []
+        if printer is not old_printer:
+            changes = self._changed_fields(old_printer, printer)
+            if changes:
+                events.append(("printer", changes))
+        old_by_uuid = {job["uuid"]: job for job in old_jobs}
+        uuids = [job["uuid"] for job in print_jobs]
+        for job in print_jobs:
+            old = old_by_uuid.get(job["uuid"])
+            if old is None:
+                events.append(("job_added", job))
+            elif old is not job:
+                changes = self._changed_fields(old, job)
+                if changes:
+                    events.append(("job_changed",
+                        {"uuid": job["uuid"], "changes": changes}))
+        current = set(uuids)
+        events.extend(("job_removed", {"uuid": uuid})
+                for uuid in old_by_uuid if uuid not in current)
+        # Only report moves, not the changes by adding and removing
+        if ([u for u in old_by_uuid if u in current]
+                != [u for u in uuids if u in old_by_uuid]):
+            events.append(("queue", {"order": uuids}))
+        return events
+
+    def encode(self, content, previous=None):
+        """
+        Return a Resource containing content encoded as JSON.
+        If the result is the same as previous, return that instead.
+        """
+        body = json.dumps(content, separators=(",", ":")).encode()
+        if previous is not None and previous.body == body:
+            return previous
+        self._generation += 1
+        etag = '"{}-{}"'.format(self._etag_prefix, self._generation)
+        return Resource(self._generation, etag, body)
+
+    def refresh(self):
+        """Request an update as soon as possible, e.g. after a queue change"""
+        self.collector.refresh()
 
-    def update_printers(self):
+    def is_printing(self):
+        return self.snapshot.printing
+
+    def printing_or_unknown(self):
+        """
+        Like is_printing(), but for the UploadThrottle, so this must not
+        block.  A snapshot older than SNAPSHOT_MAX_AGE, e.g. because
+        nobody polls, is refreshed in the background and counts as
+        printing until then.
+        """
+        snapshot = self.snapshot
+        if time.monotonic() - snapshot.time > self.SNAPSHOT_MAX_AGE:
+            self.refresh()
+            return True
+        return snapshot.printing
+
+    def update_printers(self, materials, klippy_jobs):
         """Update currently loaded material and state"""
-        materials, klippy_jobs = self.reactor.cb(
-                self.obtain_material_printjobs, wait=True)
-        self.printer_status.configuration = [ClusterPrintCoreConfiguration(
-            extruder_index=i,
-            print_core_id="AA 0.4",
-            material=material)
+        # Only replace the models if something changed, so that they
+        # don't need to be serialized again
+        if materials != self.loaded_materials:
+            self.loaded_materials = materials
+            self.printer_status.configuration = [
+                ClusterPrintCoreConfiguration(
+                    extruder_index=i,
+                    print_core_id="AA 0.4",
+                    material=material)
                 for i, material in enumerate(materials)]
         if self.module.testing:
             return
@@ -129,38 +474,42 @@ class ContentManager:
         else:
             self.printer_status.status = "idle"
 
-    @staticmethod
-    def obtain_print_jobs(e, printer):
-        return printer.objects['virtual_sdcard'].get_status()['jobs']
-
-    @staticmethod
-    def obtain_remaining_time(e, printer):
-        return printer.objects['print_stats'].get_print_time_prediction()[0]
-
-    @classmethod
-    def obtain_printjobs_time(cls, e, printer):
-        time = cls.obtain_remaining_time(e, printer)
-        printjobs = cls.obtain_print_jobs(e, printer)
-        return printjobs, time
-
-    def update_print_jobs(self):
+    def update_print_jobs(self, klippy_jobs, remaining):
         """Read queue, Update status, elapsed time"""
-        # Update self.print_jobs with the queue
-        klippy_jobs, remaining = self.reactor.cb(
-                self.obtain_printjobs_time, wait=True)
+        # Reuse the print jobs of the last update, matched by the uuid
+        # of the klippy job.  Jobs whose uuid disappeared can be taken
+        # over by new queue entries of the same file, e.g. after klippy
+        # reloaded the queue.
+        uuids = {klippy_job.uuid for klippy_job in klippy_jobs}
+        unmatched = {}
+        for path, print_jobs in self.print_jobs_by_path.items():
+            leftover = [pj for pj in print_jobs
+                        if self.klippy_uuids[pj.uuid] not in uuids]
+            if leftover:
+                unmatched[path] = leftover[::-1] # Pop from the front
         new_print_jobs = []
+        by_path = {}
+        klippy_uuids = {}
         for klippy_job in klippy_jobs:
-            print_job = None
-            # Find first cura print job with the same name
-            for j, cura_pj in enumerate(self.print_jobs):
-                if cura_pj.name == os.path.basename(klippy_job.path):
-                    print_job = self.print_jobs.pop(j)
-                    break
-            if print_job is None: # Newly added print job
-                new_print_jobs.append(self.create_cluster_print_job(klippy_job))
-            else:
-                new_print_jobs.append(print_job)
+            print_job = self.print_jobs_by_klippy_uuid.get(klippy_job.uuid)
+            if print_job is None and unmatched.get(klippy_job.path):
+                print_job = unmatched[klippy_job.path].pop()
+                self.journal.add(print_job.uuid, klippy_job.uuid,
+                        klippy_job.path, print_job.created_at, print_job.owner)
+            if print_job is None: # Newly added or restored print job
+                print_job = self.create_cluster_print_job(klippy_job)
+                self.module.upload_index.touch(klippy_job.path)
+            by_path.setdefault(klippy_job.path, []).append(print_job)
+            klippy_uuids[print_job.uuid] = klippy_job.uuid
+            new_print_jobs.append(print_job)
+        self.metadata_cache.save()
+        self.journal.retain(klippy_uuids)
         self.print_jobs = new_print_jobs
+        self.print_jobs_by_klippy_uuid = {
+                klippy_job.uuid: print_job
+                for klippy_job, print_job in zip(klippy_jobs, new_print_jobs)}
+        self.print_jobs_by_path = by_path
+        self.klippy_uuids = klippy_uuids
         self.klippy_jobs = klippy_jobs
 
         # Update first print job if there is one
@@ -175,6 +524,8 @@ class ContentManager:
             # State
             self.print_jobs[0].status = klippy_jobs[0].state
             if klippy_jobs[0].state == "printing":
+                if not self.print_jobs[0].started:
+                    self.module.upload_index.touch(klippy_jobs[0].path)
                 self.print_jobs[0].started = True
 
     @staticmethod
@@ -199,20 +550,32 @@ class ContentManager:
             raw = raw >> 8
         return ":".join([i.lstrip("0x").zfill(2) for i in hex_])
 
-    def uuid_to_print_job(self, uuid):
+    def get_snapshot(self):
         """
-        Return a tuple (index, print job) for the print job with the given
-        UUID.  Return (None, None) if the UUID could not be found.
+        Return the last published snapshot without waiting for klippy.
+        If it is older than SNAPSHOT_MAX_AGE, e.g. because updates were
+        paused while nobody was connected or klippy is busy, it is
+        returned anyway and a new one is fetched in the background.
+        Only if it is older than SNAPSHOT_MAX_STALENESS (or there is no
+        snapshot yet), wait up to STALE_WAIT seconds for a newer one and
+        raise ReactorTimeout if none arrives.
         """
-        return next(iter((i, pj) for i, pj in enumerate(self.print_jobs)
-            if pj.uuid == uuid), (None, None))
+        snapshot = self.snapshot
+        age = time.monotonic() - snapshot.time
+        if age > self.SNAPSHOT_MAX_AGE or snapshot.version == 0:
+            self.refresh()
+        if age > self.SNAPSHOT_MAX_STALENESS or snapshot.version == 0:
+            with self._published:
+                if not self._published.wait_for(self._is_servable,
+                                                self.STALE_WAIT):
+                    raise ReactorTimeout(
+                            "No status from klippy for {:.0f}s".format(age))
+                snapshot = self.snapshot
+        return snapshot
+
+    def _is_servable(self):
+        return (self.snapshot.version > 0 and time.monotonic()
+                - self.snapshot.time <= self.SNAPSHOT_MAX_STALENESS)
 
-    def get_printer_status(self):
-        self.update_printers()
-        return [self.printer_status.serialize()]
-    def get_print_jobs(self):
-        if not self.module.testing:
-            self.update_print_jobs()
-        return [m.serialize() for m in self.print_jobs]
     def get_materials(self):
-        return [m.serialize() for m in self.materials]
+        return self.materials_resource
@@ -16,7 +16,14 @@ import time
 import queuelogger
 
 from .contentmanager import ContentManager
+from .memwatch import MemoryWatchdog
+from .metrics import MetricsRegistry
+from .profiler import Profiler
 from . import server
+from .reactorbridge import ReactorBridge
+from .storagemanager import StorageManager
+from .uploadindex import UploadIndex
+from .uploadthrottle import UploadThrottle
 from .zeroconfhandler import ZeroConfHandler
 
 LOGFILE = "/tmp/klipper_cura_connection.log"
@@ -26,6 +33,16 @@ class CuraConnectionModule:
     # How many seconds after the last request to consider disconnected
     # 4.2 allows missing just one update cycle (every 2sec)
     CONNECTION_TIMEOUT = 4.2
+    # "asyncio" serves all connections from one event loop,
+    # "threading" uses one thread per connection
+    SERVER_MODE = "asyncio"
+    # Environment variables: "1" enables the /debug/ endpoints, e.g. for
+    # profiling.  "requests=N" profiles the first N requests, "seconds=T"
+    # samples all stacks for T seconds after the start.  "1" traces
+    # memory allocations to find leaks.
+    DEBUG_ENV = "CURA_CONNECTION_DEBUG"
+    PROFILE_ENV = "CURA_CONNECTION_PROFILE"
+    MEMWATCH_ENV = "CURA_CONNECTION_MEMWATCH"
 
     def __init__(self, config):
         self._log_queue = queuelogger.setup_bg_logging(LOGFILE, logging.INFO)
@@ -39,9 +56,18 @@ class CuraConnectionModule:
         self.PATH = os.path.dirname(os.path.realpath(__file__))
         self.SDCARD_PATH = os.path.expanduser("~/Files")
         self.MATERIAL_PATH = os.path.expanduser("~/materials")
+        self.CACHE_PATH = os.path.expanduser("~/.cache/klipper_cura_connection")
         self.ADDRESS = None
+        self.DEBUG = os.environ.get(self.DEBUG_ENV) == "1"
 
+        self.metrics = None
+        self.profiler = None
+        self.memory_watchdog = None
+        self.reactor_bridge = None
         self.content_manager = None
+        self.upload_index = None
+        self.upload_throttle = None
+        self.storage_manager = None
         self.zeroconf_handler = None
         self.server = None
         self.reactor = config.get_reactor()
@@ -79,14 +105,41 @@ class CuraConnectionModule:
 
     def start(self):
         """Start the zeroconf service, and the server in a seperate thread"""
+        self.metrics = MetricsRegistry()
+        self.profiler = Profiler(os.path.dirname(LOGFILE))
+        if self.PROFILE_ENV in os.environ:
+            self.start_profiling(os.environ[self.PROFILE_ENV])
+        self.memory_watchdog = MemoryWatchdog(self.metrics,
+                trace=os.environ.get(self.MEMWATCH_ENV) == "1")
+        self.reactor_bridge = ReactorBridge(self.reactor, self.metrics)
         self.content_manager = ContentManager(self)
+        self.upload_index = UploadIndex(self.SDCARD_PATH,
+                os.path.join(self.CACHE_PATH, "upload_index.json"))
+        self.upload_throttle = UploadThrottle(
+                self.content_manager.printing_or_unknown, self.metrics)
+        self.storage_manager = StorageManager(self)
         self.zeroconf_handler = ZeroConfHandler(self)
         self.server = server.get_server(self)
 
         self.zeroconf_handler.start() # Non-blocking
+        self.content_manager.start() # Starts collector thread
         self.server.start() # Starts server thread
+        self.memory_watchdog.start()
         logging.debug("Cura Connection Server started")
 
+    def start_profiling(self, setting):
+        """Start the profiler according to PROFILE_ENV"""
+        kind, _, value = setting.partition("=")
+        try:
+            if kind == "requests":
+                self.profiler.profile_requests(int(value))
+            elif kind == "seconds":
+                self.profiler.sample(float(value))
+            else:
+                raise ValueError("Unknown kind of profiling: " + kind)
+        except ValueError as e:
+            logging.error("Invalid %s=%s: %s", self.PROFILE_ENV, setting, e)
+
     def handle_disconnect(self, *args):
         """
         This might take a little while, be patient
@@ -99,16 +152,21 @@ class CuraConnectionModule:
                 self.server.shutdown()
                 self.server.join()
                 logging.debug("Cura Connection Server shut down")
+            self.content_manager.stop()
+            self.reactor_bridge.shutdown()
+            self.memory_watchdog.stop()
         self.reactor.register_async_callback(self.reactor.end)
         self._log_queue.stop()
 
     def is_connected(self):
         """
-        Return true if there currently is an active connection.
-        Also see CONNECTION_TIMEOUT
+        Return true if there currently is an active connection, that is
+        a recent request (see CONNECTION_TIMEOUT) or an open event stream.
         """
-        return (self.server is not None and
-                time.time() - self.server.last_request < self.CONNECTION_TIMEOUT)
+        if self.server is None:
+            return False
+        return (time.time() - self.server.last_request < self.CONNECTION_TIMEOUT
+                or self.content_manager.events.subscribers > 0)
 
     @staticmethod
     def add_print(e, printer, path):
@@ -138,10 +196,9 @@ class CuraConnectionModule:
     def queue_move(e, printer, index, uuid, move):
         return printer.objects['virtual_sdcard'].move_print(index, uuid, move)
 
-    def get_thumbnail_path(self, index, filename):
-        """Return the thumbnail path for the specified print"""
-        md = self.metadata.get_metadata(self.content_manager.klippy_jobs[index].path)
-        path = md.get_thumbnail_path()
+    def get_thumbnail_path(self, job_path):
+        """Return the thumbnail path for the G-Code file at job_path"""
+        path = self.content_manager.get_thumbnail_path(job_path)
         if not path or not os.path.exists(path):
             path = os.path.join(self.PATH, "default.png")
         return path
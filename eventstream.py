@@ -0,0 +1,117 @@
+from collections import deque
+import contextlib
+import json
+import threading
+import uuid as uuid_lib
+
+
+class EventStream:
+    """
+    Changes of the printer and the print jobs as Server-Sent Events.
+
+    ContentManager publishes the differences between two snapshots
+    once, when the new snapshot is published, along with the complete
+    new state.  The last HISTORY events are kept already encoded, so
+    any number of clients can read them without further work.
+
+    Event ids contain a prefix that changes with every start.  A client
+    that reconnects with a Last-Event-ID that is unknown or too old to
+    be in the history gets the complete state as "snapshot" event.
+    """
+
+    # Number of events kept for clients that reconnect
+    HISTORY = 256
+    # Sent when there is nothing new, so that dead connections are noticed
+    KEEPALIVE = b": keepalive\n\n"
+
+    def __init__(self):
+        self._prefix = uuid_lib.uuid4().hex[:8]
+        self._cond = threading.Condition()
+        self._history = deque(maxlen=self.HISTORY) # (id, encoded event)
+        self._last_id = 0
+        self._state = None # JSON of the complete state at _last_id
+        self._listeners = []
+        self._closed = False
+        self.subscribers = 0
+
+    def _format(self, event_id, event, data):
+        return "id: {}-{}\nevent: {}\ndata: {}\n\n".format(
+                self._prefix, event_id, event, data).encode()
+
+    def publish(self, events, state):
+        """
+        Add events, a list of (event, data) pairs where data can be
+        encoded as JSON, and set the complete state, encoded as JSON.
+        """
+        with self._cond:
+            for event, data in events:
+                self._last_id += 1
+                self._history.append((self._last_id, self._format(
+                    self._last_id, event,
+                    json.dumps(data, separators=(",", ":")))))
+            self._state = state
+            self._cond.notify_all()
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener()
+
+    def _parse_id(self, last_event_id):
+        prefix, _, number = (last_event_id or "").partition("-")
+        if prefix != self._prefix or not number.isdigit():
+            return None
+        return int(number)
+
+    def read(self, last_event_id):
+        """
+        Return the encoded events after last_event_id and the id of the
+        last of them.  That is a snapshot of the complete state if the
+        events since last_event_id aren't known, or b"" if there are no
+        new events.  Return (None, None) once the stream is closed.
+        """
+        last = self._parse_id(last_event_id)
+        with self._cond:
+            if self._closed:
+                return None, None
+            current = "{}-{}".format(self._prefix, self._last_id)
+            oldest = self._history[0][0] if self._history else self._last_id + 1
+            if last is None or last > self._last_id or last < oldest - 1:
+                if self._state is None:
+                    return b"", last_event_id
+                return self._format(self._last_id, "snapshot",
+                        self._state.decode()), current
+            return b"".join(encoded for event_id, encoded in self._history
+                            if event_id > last), current
+
+    def wait(self, last_event_id, timeout):
+        """Block until there are events after last_event_id or timeout"""
+        last = self._parse_id(last_event_id)
+        with self._cond:
+            self._cond.wait_for(lambda: self._closed or self._state
+                    is not None and last != self._last_id, timeout)
+
+    @contextlib.contextmanager
+    def subscription(self, listener=None):
+        """
+        Context manager for the time a client reads the stream.
+        listener is called without arguments after every publish.
+        """
+        with self._cond:
+            self.subscribers += 1
+            if listener is not None:
+                self._listeners.append(listener)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.subscribers -= 1
+                if listener is not None:
+                    self._listeners.remove(listener)
+
+    def close(self):
+        """End all streams"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener()
@@ -0,0 +1,104 @@
+import base64
+import binascii
+import logging
+import re
+
+
+class HeaderScanner:
+    """
+    Extract metadata from the header comments of a G-Code file while it
+    is being written, so that the file doesn't need to be read again.
+
+    All data of the file is passed to feed() in order.  Only the
+    beginning of the file is looked at, up to the first layer or
+    SCAN_LIMIT bytes, after which done is set and feed() returns
+    immediately.  The following is read from the comments written by
+    Cura (both Griffin and Marlin flavor):
+
+    time            Estimated print time in seconds or None
+    material_guids  List of the material GUIDs for every extruder,
+                    None where no GUID is specified
+    thumbnail       Decoded PNG data of the largest embedded thumbnail
+                    or None
+    """
+
+    # Only this many bytes at the beginning of a file are scanned
+    SCAN_LIMIT = 1024 * 1024
+
+    _extruder_regex = re.compile(rb";EXTRUDER_TRAIN\.(\d+)\.")
+    _thumbnail_regex = re.compile(rb"; thumbnail begin (\d+)x(\d+)")
+
+    def __init__(self):
+        self.done = False
+        self.time = None
+        self.material_guids = []
+        self.thumbnail = None
+        self._scanned = 0
+        self._partial = b"" # Incomplete last line of the previous chunk
+        self._thumbnail_lines = None # Set while inside a thumbnail block
+        self._thumbnail_size = 0
+        self._best_thumbnail_size = 0
+
+    def feed(self, data):
+        """Scan the next chunk of data"""
+        if self.done:
+            return
+        self._scanned += len(data)
+        lines = (self._partial + bytes(data)).split(b"\n")
+        self._partial = lines.pop()
+        for line in lines:
+            if line.startswith(b";"):
+                self._parse_comment(line.rstrip(b"\r"))
+                if self.done:
+                    return
+        if self._scanned > self.SCAN_LIMIT:
+            self.close()
+
+    def close(self):
+        """Stop scanning, e.g. at the end of the file"""
+        if not self.done and self._partial.startswith(b";"):
+            self._parse_comment(self._partial.rstrip(b"\r"))
+        self.done = True
+        self._partial = b""
+        self._thumbnail_lines = None
+
+    def _parse_comment(self, line):
+        if self._thumbnail_lines is not None:
+            if line.startswith(b"; thumbnail end"):
+                self._end_thumbnail()
+            else:
+                self._thumbnail_lines.append(line[1:].strip())
+        elif line.startswith(b";LAYER:"):
+            # Header and start gcode are over
+            self.close()
+        elif line.startswith((b";PRINT.TIME:", b";TIME:")):
+            try:
+                self.time = int(line.split(b":", 1)[1])
+            except ValueError:
+                pass
+        elif line.startswith(b";EXTRUDER_TRAIN."):
+            m = self._extruder_regex.match(line)
+            if m:
+                index = int(m.group(1))
+                while len(self.material_guids) <= index:
+                    self.material_guids.append(None)
+                if line.startswith(b"MATERIAL.GUID:", m.end()):
+                    self.material_guids[index] = line.split(
+                            b":", 1)[1].strip().decode() or None
+        elif line.startswith(b"; thumbnail begin"):
+            m = self._thumbnail_regex.match(line)
+            if m:
+                self._thumbnail_lines = []
+                self._thumbnail_size = int(m.group(1)) * int(m.group(2))
+
+    def _end_thumbnail(self):
+        """Decode the thumbnail, if it is the largest one so far"""
+        lines, self._thumbnail_lines = self._thumbnail_lines, None
+        if self._thumbnail_size <= self._best_thumbnail_size:
+            return
+        try:
+            self.thumbnail = base64.b64decode(b"".join(lines), validate=True)
+        except binascii.Error:
+            logging.warning("Failed to decode thumbnail")
+        else:
+            self._best_thumbnail_size = self._thumbnail_size
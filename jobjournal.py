@@ -0,0 +1,192 @@
+import json
+import logging
+import os
+import threading
+import time
+
+
+class JobJournal:
+    """
+    Append-only journal of the print jobs in the queue, so that they
+    keep their identity when the module is restarted.  For every job the
+    journal stores a dictionary of
+
+    uuid            UUID of the print job as known by Cura
+    klippy_uuid     UUID of the job in the virtual_sdcard queue
+    path            Path of the G-Code file
+    digest          Digest of size and inode of the file
+    created_at      Time the job was created, as in the model
+    owner           Name of the user that uploaded the job or None
+
+    Every change is appended to the file as one JSON line, removals as
+    {"uuid": ..., "removed": true}.  The file is rewritten once it
+    contains many more lines than there are jobs.
+
+    Jobs from before the start that aren't claimed once klippy has
+    restored its queue are removed, see retain().
+    """
+
+    # Rewrite the file when it has more lines than this plus twice the
+    # number of jobs
+    COMPACT_SLACK = 64
+    # Seconds to keep unclaimed jobs from before the start while
+    # klippy's queue is empty
+    RESTORE_TIMEOUT = 60
+
+    def __init__(self, journal_path):
+        self.journal_path = journal_path
+        self._lock = threading.Lock()
+        self._entries = {} # uuid: entry
+        self._by_klippy_uuid = {} # klippy_uuid: uuid
+        self._by_file = {} # (path, digest): [uuid, ...]
+        self._claimed = set() # uuids that are in use since startup
+        self._started = time.monotonic()
+        self._restored = False # Whether unclaimed jobs were removed
+        self._lines = 0
+        self._fp = None
+        self._load()
+
+    @staticmethod
+    def file_digest(path):
+        """Return the digest of a file as stored in the journal or None"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return "{:x}-{:x}".format(st.st_size, st.st_ino)
+
+    def _load(self):
+        try:
+            with open(self.journal_path, "r") as fp:
+                for line in fp:
+                    self._lines += 1
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Most likely a line that wasn't written completely
+                        logging.warning("Skipping broken line in job journal")
+                        continue
+                    if record.get("removed"):
+                        self._discard(record["uuid"])
+                    else:
+                        self._insert(record)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            logging.exception("Failed to load job journal, starting empty")
+        # Forget jobs of files that were removed or replaced
+        for uuid, entry in list(self._entries.items()):
+            if self.file_digest(entry["path"]) != entry["digest"]:
+                self._discard(uuid)
+
+    def _insert(self, entry):
+        """Add entry to the in-memory indexes, replacing an older one"""
+        self._discard(entry["uuid"])
+        self._entries[entry["uuid"]] = entry
+        self._by_klippy_uuid[entry["klippy_uuid"]] = entry["uuid"]
+        self._by_file.setdefault(
+                (entry["path"], entry["digest"]), []).append(entry["uuid"])
+
+    def _discard(self, uuid):
+        entry = self._entries.pop(uuid, None)
+        if entry is None:
+            return
+        if self._by_klippy_uuid.get(entry["klippy_uuid"]) == uuid:
+            del self._by_klippy_uuid[entry["klippy_uuid"]]
+        key = (entry["path"], entry["digest"])
+        self._by_file[key].remove(uuid)
+        if not self._by_file[key]:
+            del self._by_file[key]
+
+    def _append(self, record):
+        """Write a record to the journal, must be called with the lock held"""
+        if self._lines > 2 * len(self._entries) + self.COMPACT_SLACK:
+            self._compact()
+        if self._fp is None:
+            os.makedirs(os.path.dirname(self.journal_path), exist_ok=True)
+            self._fp = open(self.journal_path, "a")
+        self._fp.write(json.dumps(record, separators=(",", ":")) + "\n")
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+        self._lines += 1
+
+    def _compact(self):
+        """Rewrite the journal with only the current entries"""
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+        temp_path = self.journal_path + ".tmp"
+        with open(temp_path, "w") as fp:
+            for entry in self._entries.values():
+                fp.write(json.dumps(entry, separators=(",", ":")) + "\n")
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(temp_path, self.journal_path)
+        self._lines = len(self._entries)
+
+    def claim(self, klippy_uuid, path, match_file=True):
+        """
+        Return the entry of a job that was in the queue before, for the
+        klippy job with klippy_uuid and path, or None.  If klippy has
+        assigned a new uuid and match_file is True, an entry for the
+        same unchanged file is taken over.  Every entry can only be
+        claimed once.
+        """
+        with self._lock:
+            uuid = self._by_klippy_uuid.get(klippy_uuid)
+            if uuid is None or uuid in self._claimed:
+                if not match_file:
+                    return None
+                uuid = next((u for u in self._by_file.get(
+                    (path, self.file_digest(path)), ())
+                    if u not in self._claimed), None)
+                if uuid is None:
+                    return None
+            self._claimed.add(uuid)
+            entry = self._entries[uuid]
+            if entry["klippy_uuid"] != klippy_uuid:
+                entry = dict(entry, klippy_uuid=klippy_uuid)
+                self._insert(entry)
+                self._append(entry)
+            return entry
+
+    def add(self, uuid, klippy_uuid, path, created_at, owner):
+        """Record a new job"""
+        entry = {
+            "uuid": uuid,
+            "klippy_uuid": klippy_uuid,
+            "path": path,
+            "digest": self.file_digest(path),
+            "created_at": created_at,
+            "owner": owner,
+        }
+        with self._lock:
+            self._claimed.add(uuid)
+            self._insert(entry)
+            self._append(entry)
+
+    def retain(self, uuids):
+        """
+        Remove all jobs that were claimed or added since startup and
+        whose uuid is not in uuids, the jobs currently in the queue.
+        Unclaimed jobs from before the start are removed as well the
+        first time the queue isn't empty, or after RESTORE_TIMEOUT.
+        Until then klippy might not have restored its queue yet.
+        """
+        with self._lock:
+            removed = [u for u in self._claimed if u not in uuids]
+            if not self._restored and (uuids or time.monotonic()
+                    - self._started > self.RESTORE_TIMEOUT):
+                self._restored = True
+                removed.extend(u for u in self._entries
+                               if u not in self._claimed)
+            for uuid in removed:
+                self._discard(uuid)
+                self._claimed.discard(uuid)
+                self._append({"uuid": uuid, "removed": True})
+
+    def close(self):
+        with self._lock:
+            if self._fp is not None:
+                self._fp.close()
+                self._fp = None
@@ -0,0 +1,130 @@
+import gc
+import logging
+import os
+import resource
+import threading
+import tracemalloc
+
+
+class MemoryWatchdog(threading.Thread):
+    """
+    Thread that keeps an eye on the memory usage of the module, so that
+    slow leaks are noticed long before the OOM killer stops a print.
+
+    Every INTERVAL seconds the resident set size is checked and a
+    warning is logged once it exceeds RSS_LIMIT, and again whenever it
+    grew by another RSS_WARN_GROWTH since the last warning.
+
+    With trace=True, tracemalloc is started and every check also logs
+    which of the TOP_SITES source lines with the most allocation growth
+    since the start grew by at least LOG_GROWTH bytes.  Tracing costs
+    memory and CPU time, so it is off by default.  report() returns the
+    same information for /debug/memory.
+    """
+
+    # Seconds between two checks
+    INTERVAL = 600
+    # Resident set size in bytes above which a warning is logged
+    RSS_LIMIT = 256 * 1024**2
+    # Factor by which the RSS must grow to warn again
+    RSS_WARN_GROWTH = 1.25
+    # Number of allocation sites to report
+    TOP_SITES = 10
+    # Bytes an allocation site must have grown by to be logged
+    LOG_GROWTH = 64 * 1024
+
+    # Allocations that say nothing about the module
+    TRACE_FILTERS = (
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        tracemalloc.Filter(False, "<unknown>"),
+    )
+
+    def __init__(self, metrics, trace=False):
+        super().__init__(name="Memory-Watchdog", daemon=True)
+        self.trace = trace
+        self._wakeup = threading.Event()
+        self._running = True
+        self._warn_at = self.RSS_LIMIT
+        self._baseline = None
+        metrics.gauge("cura_process_rss_bytes", "Resident set size",
+                function=self.rss)
+        metrics.gauge("cura_threads", "Number of running threads",
+                function=threading.active_count)
+
+    @staticmethod
+    def rss():
+        """Current resident set size in bytes"""
+        try:
+            with open("/proc/self/statm", "r") as fp:
+                return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, IndexError):
+            # Not on Linux, use the peak instead
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def run(self):
+        if self.trace:
+            tracemalloc.start()
+            self._baseline = self._snapshot()
+            logging.info("Tracing memory allocations")
+        while self._running:
+            self._wakeup.wait(self.INTERVAL)
+            if not self._running:
+                break
+            try:
+                self.check()
+            except Exception:
+                logging.exception("Memory check failed")
+        if self.trace:
+            tracemalloc.stop()
+
+    def stop(self):
+        self._running = False
+        self._wakeup.set()
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces(self.TRACE_FILTERS)
+
+    def growth(self):
+        """
+        Return a list of (site, size_diff, count_diff) of the source
+        lines whose allocations grew the most since the start.
+        """
+        if self._baseline is None or not tracemalloc.is_tracing():
+            return []
+        stats = self._snapshot().compare_to(self._baseline, "lineno")
+        return [(str(stat.traceback[0]), stat.size_diff, stat.count_diff)
+                for stat in stats[:self.TOP_SITES] if stat.size_diff > 0]
+
+    def check(self):
+        """Log the memory growth and warn if RSS is too large"""
+        rss = self.rss()
+        growth = [site for site in self.growth()
+                  if site[1] >= self.LOG_GROWTH]
+        if rss > self._warn_at:
+            logging.warning("Memory usage is %.1f MB, limit is %.1f MB",
+                    rss / 1e6, self.RSS_LIMIT / 1e6)
+            self._warn_at = rss * self.RSS_WARN_GROWTH
+        elif growth:
+            logging.info("Memory usage is %.1f MB", rss / 1e6)
+        for site, size_diff, count_diff in growth:
+            logging.info("Memory growth %+.1f kB (%+d blocks) at %s",
+                    size_diff / 1e3, count_diff, site)
+
+    def report(self):
+        """Return the current memory state as dictionary"""
+        report = {
+            "rss": self.rss(),
+            "rss_limit": self.RSS_LIMIT,
+            "threads": [t.name for t in threading.enumerate()],
+            "gc_objects": len(gc.get_objects()),
+            "tracing": tracemalloc.is_tracing(),
+        }
+        if tracemalloc.is_tracing():
+            report["traced"], report["traced_peak"] = (
+                    tracemalloc.get_traced_memory())
+            report["growth"] = [
+                    {"site": site, "size_diff": size, "count_diff": count}
+                    for site, size, count in self.growth()]
+        return report
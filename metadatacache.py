@@ -0,0 +1,99 @@
+import json
+import logging
+import os
+import threading
+
+
+class MetadataCache:
+    """
+    Persistent cache of the metadata of G-Code files, so that the files
+    don't need to be parsed again after a restart.  Entries are keyed by
+    path and only valid as long as size and modification time of the
+    file stay the same.  Every entry is a dictionary of
+
+    materials   List with a material dictionary for every extruder,
+                containing guid, brand, color and material
+    time        Estimated print time in seconds or None
+    thumbnail   Path to a thumbnail image or None
+
+    Changes are only written to cache_path by save().
+    """
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self._lock = threading.Lock()
+        self._entries = {} # path: [size, mtime, entry]
+        self._changed = False
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.cache_path, "r") as fp:
+                entries = json.load(fp)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            logging.exception("Failed to load metadata cache, starting empty")
+            return
+        # Drop entries of files that don't exist anymore
+        for path, value in entries.items():
+            if os.path.exists(path):
+                self._entries[path] = value
+            else:
+                self._changed = True
+
+    def save(self):
+        """Write the cache to disk if anything changed"""
+        with self._lock:
+            if not self._changed:
+                return
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            temp_path = self.cache_path + ".tmp"
+            with open(temp_path, "w") as fp:
+                json.dump(self._entries, fp)
+            os.replace(temp_path, self.cache_path)
+            self._changed = False
+
+    @staticmethod
+    def _stat(path):
+        """Return the key that an entry for path must match, or None"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return [st.st_size, st.st_mtime_ns]
+
+    def get(self, path):
+        """Return the entry for path or None if it is missing or stale"""
+        key = self._stat(path)
+        with self._lock:
+            value = self._entries.get(path)
+            if value is None:
+                return None
+            if key is None or value[:2] != key:
+                del self._entries[path]
+                self._changed = True
+                return None
+            return value[2]
+
+    def put(self, path, materials, time, thumbnail):
+        """Add or replace the entry for the file at path"""
+        key = self._stat(path)
+        if key is None:
+            return
+        with self._lock:
+            self._entries[path] = key + [{
+                "materials": materials,
+                "time": time,
+                "thumbnail": thumbnail,
+            }]
+            self._changed = True
+
+    def pop(self, path):
+        """Remove and return the entry for path, if there is one"""
+        with self._lock:
+            value = self._entries.pop(path, None)
+            if value is None:
+                return None
+            self._changed = True
+            return value[2]
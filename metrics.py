@@ -0,0 +1,237 @@
+from bisect import bisect_left
+import math
+import threading
+
+
+# Default histogram buckets in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10)
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        return repr(value)
+    return str(value)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value)
+        .replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n"))
+        for name, value in zip(names, values)) + "}"
+
+
+class _Metric:
+    """
+    Base class of all metrics.  A metric with label names has a child
+    for every combination of label values, see labels().  Without
+    labels, the metric itself is updated directly.
+
+    Subclasses define TYPE and _new_child(), which returns a new child.
+    """
+
+    TYPE = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._children = {} # label values: child
+        if not self.label_names:
+            self._default = self._children[()] = self._new_child()
+
+    def labels(self, *values):
+        """Return the child for the given label values"""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError("Expected labels " + repr(self.label_names))
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def render(self):
+        """Return the lines of the metric in the Prometheus text format"""
+        lines = ["# HELP {} {}".format(self.name, self.documentation),
+                 "# TYPE {} {}".format(self.name, self.TYPE)]
+        for values, child in list(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+    def _render_child(self, values, child):
+        return ["{}{} {}".format(self.name,
+            _format_labels(self.label_names, values),
+            _format_value(child.get()))]
+
+
+class _Value:
+    __slots__ = ("_lock", "value")
+
+    def __init__(self, lock):
+        self._lock = lock
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+class _FunctionValue:
+    __slots__ = ("get",)
+
+    def __init__(self, function):
+        self.get = function
+
+
+class Counter(_Metric):
+    """A value that only ever increases, e.g. the number of requests"""
+
+    TYPE = "counter"
+
+    def _new_child(self):
+        return _Value(self._lock)
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+
+class Gauge(_Metric):
+    """
+    A value that can go up and down.  If function is given, the value
+    is only determined when the metrics are rendered by calling it.
+    """
+
+    TYPE = "gauge"
+
+    def __init__(self, name, documentation, labels=(), function=None):
+        super().__init__(name, documentation, labels)
+        if function is not None:
+            if self.label_names:
+                raise ValueError("Gauges with a function can't have labels")
+            self._default = self._children[()] = _FunctionValue(function)
+
+    def _new_child(self):
+        return _Value(self._lock)
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def dec(self, amount=1):
+        self._default.dec(amount)
+
+    def set(self, value):
+        self._default.set(value)
+
+
+class _HistogramValue:
+    __slots__ = ("_lock", "_buckets", "counts", "sum")
+
+    def __init__(self, lock, buckets):
+        self._lock = lock
+        self._buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # Last one is +Inf
+        self.sum = 0
+
+    def observe(self, value):
+        i = bisect_left(self._buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+
+class Histogram(_Metric):
+    """
+    Counts observed values, e.g. durations, in buckets with fixed upper
+    bounds, along with their sum.
+    """
+
+    TYPE = "histogram"
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labels)
+
+    def _new_child(self):
+        return _HistogramValue(self._lock, self.buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def _render_child(self, values, child):
+        with self._lock:
+            counts = list(child.counts)
+            total = child.sum
+        names = self.label_names + ("le",)
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            cumulative += count
+            lines.append("{}_bucket{} {}".format(self.name,
+                _format_labels(names, values + (_format_value(bound),)),
+                cumulative))
+        labels = _format_labels(self.label_names, values)
+        lines.append("{}_sum{} {}".format(self.name, labels,
+            _format_value(total)))
+        lines.append("{}_count{} {}".format(self.name, labels, cumulative))
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Collection of all metrics of the module, exposed in the Prometheus
+    text format at /metrics.  Updating a metric only takes a lock and
+    an addition, so they are always enabled.
+
+    Registering a name a second time returns the existing metric, as
+    long as it is of the same type.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {} # name: metric
+
+    def _register(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif type(metric) is not cls:
+                raise ValueError("Metric {} already registered as {}".format(
+                    name, metric.TYPE))
+            return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self._register(Counter, name, documentation, labels)
+
+    def gauge(self, name, documentation, labels=(), function=None):
+        return self._register(Gauge, name, documentation, labels,
+                function=function)
+
+    def histogram(self, name, documentation, labels=(),
+                  buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, documentation, labels,
+                buckets=buckets)
+
+    def render(self):
+        """Return all metrics in the Prometheus text format"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
@@ -1,6 +1,14 @@
+import contextlib
 import email
+import hashlib
 import logging
 import os
+import zlib
+
+from .headerscanner import HeaderScanner
+
+class PayloadTooLarge(ValueError):
+    """Raised when a message exceeds the size limits of MimeParser"""
 
 
 class MimeParser:
@@ -14,6 +22,12 @@ class MimeParser:
     specified by out_dir.
     If the file already exists and overwrite is set to False, it will
     be renamed (see _unique_path() for details).
+    With an UploadIndex, files that already exist with the same content
+    are not written again.  Instead the existing file is reused.
+    Files that are compressed with gzip or deflate, either indicated by
+    a Content-Encoding header of the part or a ".gz" extension, are
+    decompressed while writing.  Corrupt compressed data raises
+    zlib.error.
 
     Arguments:
     fp          The file pointer to parse from
@@ -23,27 +37,72 @@ class MimeParser:
     overwrite   In case a file with the same name exists overwrite it
                 if True, write to a unique, indexed name otherwise.
                 Defaults to True.
+    max_part_size   Maximum size in bytes of the headers and body of a
+                single part that is not a file.
+    max_total_size  Maximum size in bytes of everything that is not
+                written to a file.  Every part counts PART_OVERHEAD
+                bytes more, for the Message object kept for it.
+                Exceeding either limit raises PayloadTooLarge.
+    scan_gcode  If True, scan the header of all written files with a
+                HeaderScanner.  The scanners are available in the
+                metadata dictionary by path of the written file.
+    index       An UploadIndex of out_dir, used for finding duplicates
+                and allocating unique names.  Only used with
+                overwrite=False.
+    throttle    An UploadThrottle through which all files are written.
+    reservation The reservation of StorageManager.upload() that all
+                written (decompressed) bytes are counted against.
     """
 
     HEADERS = 0
     BODY = 1
     FILE = 2
 
-    def __init__(self, fp, boundary, length, out_dir, overwrite=True):
+    # Size of the buffer used for reading files
+    BUFFER_SIZE = 256 * 1024
+    # Maximum size of decompressed data produced at once
+    DECOMPRESS_SIZE = 1024 * 1024
+    # Default limits for everything kept in memory
+    MAX_PART_SIZE = 64 * 1024
+    MAX_TOTAL_SIZE = 1024 * 1024
+    # Bytes counted for every part, even if it is empty
+    PART_OVERHEAD = 1024
+
+    def __init__(self, fp, boundary, length, out_dir, overwrite=True,
+                 max_part_size=MAX_PART_SIZE, max_total_size=MAX_TOTAL_SIZE,
+                 scan_gcode=False, index=None, throttle=None,
+                 reservation=None):
         self.fp = fp
         self.boundary = boundary.encode()
         self.bytes_left = length
         self.out_dir = out_dir
         self.overwrite = overwrite
+        self.max_part_size = max_part_size
+        self.max_total_size = max_total_size
         self.submessages = []
         self.written_files = [] # All files that were written
+        self.scan_gcode = scan_gcode
+        self.metadata = {} # HeaderScanners by path
+        self.index = None if overwrite else index
+        self.throttle = throttle
+        self.reservation = reservation
 
         # What we are reading right now. One of:
         # self.HEADERS, self.BODY, self.FILE (0, 1, 2)
         self._state = None
-        self._current_headers = b""
-        self._current_body = b""
+        # Lists of lines, only joined once the part is complete
+        self._current_headers = []
+        self._current_body = []
+        self._part_size = 0 # Bytes in memory for the current part
+        self._total_size = 0 # Bytes in memory for the whole message
         self.fpath = "" # Path to the file to write to
+        self._buffer = None # Allocated for the first file
+        self._decompressor = None # For compressed files
+        self._scanner = None
+        self._hash = None # Content hash of the current file
+        self._filename = None # Name of the current file as transmitted
+        # Data that was read past the end of a file
+        self._pending = b""
 
     def parse(self):
         """
@@ -52,8 +111,9 @@ class MimeParser:
         which are directly written to disk.
         """
         while True:
-            line = self.fp.readline()
-            self.bytes_left -= len(line)
+            line = self._readline()
+            if not line:
+                raise ValueError("Unexpected end of message")
             try:
                 self._parse_line(line)
             except StopIteration:
@@ -69,8 +129,9 @@ class MimeParser:
         if line.startswith(b"--" + self.boundary):
             if self._current_body:
                 self.submessages[-1].set_payload(
-                        self._current_body.rstrip(b"\r\n"))
-                self._current_body = b""
+                        b"".join(self._current_body).rstrip(b"\r\n"))
+                self._current_body = []
+            self._part_size = 0
             self._state = self.HEADERS # Read headers next
             # This is the last line of the MIME message
             if line.strip() == b"--" + self.boundary + b"--":
@@ -89,79 +150,213 @@ class MimeParser:
     def _parse_headers(self, line):
         """Add the new line to the headers or parse the full header"""
         if line == b"\r\n": # End of headers
-            headers_message = email.message_from_bytes(self._current_headers)
-            self._current_headers = b""
+            self._count(self.PART_OVERHEAD)
+            headers_message = email.message_from_bytes(
+                    b"".join(self._current_headers))
+            self._current_headers = []
             self.submessages.append(headers_message)
             self._start_body(headers_message)
         else:
-            self._current_headers += line
+            self._keep_line(self._current_headers, line)
 
     def _parse_body(self, line):
-        self._current_body += line
+        self._keep_line(self._current_body, line)
+
+    def _keep_line(self, lines, line):
+        """Append line to lines, unless that exceeds a size limit"""
+        self._count(len(line))
+        lines.append(line)
+
+    def _count(self, size):
+        """Count size bytes against the limits"""
+        self._part_size += size
+        self._total_size += size
+        if self._part_size > self.max_part_size:
+            raise PayloadTooLarge("Part of message exceeds {} bytes".format(
+                self.max_part_size))
+        if self._total_size > self.max_total_size:
+            raise PayloadTooLarge("Message fields exceed {} bytes".format(
+                self.max_total_size))
 
     def _write_file(self):
         """
         Write the file following in fp directly to the disk.
-        This does not happen line by line because with a lot of very
-        short lines that is quite inefficient. Instead the file is copied
-        in blocks with a size of 1024 bytes.
-        Then parse the remaining lines that have been read into the
-        buffer but do not belong to the file (everything past the first
-        occurance of boundary).
+        The data is read into one reusable buffer, of which everything
+        up to the delimiter is written out directly without copying.
+        When no delimiter is found, only the last few bytes, which
+        could be the beginning of a delimiter that was cut in half, are
+        kept in the buffer for the next search.
+        Everything past the delimiter is kept in self._pending and
+        parsed normally afterwards.
         """
         # Write to this first to avoid the file browser crashing
         temp_path = self.fpath + ".part"
 
         logging.debug("Writing file: %s", self.fpath)
+        if self.scan_gcode:
+            self._scanner = HeaderScanner()
+        if self.index is not None:
+            self._hash = hashlib.blake2b(digest_size=20)
+
+        # The file ends with the CRLF before the boundary
+        delimiter = b"\r\n--" + self.boundary
+        keep = len(delimiter) - 1
+        if self._buffer is None:
+            self._buffer = bytearray(self.BUFFER_SIZE)
+        buf = self._buffer
+        try:
+            with memoryview(buf) as view, open(temp_path, "wb") as out_fp, \
+                    self._open_writer(out_fp) as write_fp:
+                # Start with what has already been read
+                filled = len(self._pending)
+                buf[:filled] = self._pending
+                self._pending = b""
+                while True:
+                    index = buf.find(delimiter, 0, filled)
+                    if index >= 0:
+                        self._write_data(write_fp, view[:index])
+                        # Continue parsing at the boundary line
+                        self._pending = bytes(view[index+2:filled])
+                        break
+                    safe = filled - keep
+                    if safe > 0:
+                        self._write_data(write_fp, view[:safe])
+                        buf[:keep] = bytes(view[safe:filled])
+                        filled = keep
+                    n = self._readinto(view[filled:])
+                    if n == 0:
+                        raise ValueError("Unexpected end of message")
+                    filled += n
+                if self._decompressor is not None:
+                    if not self._decompressor.eof:
+                        raise ValueError("Compressed file is incomplete")
+                    self._write_out(write_fp, self._decompressor.flush())
+        except BaseException:
+            # Don't leave incomplete files behind, if there are any
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(temp_path)
+            if self.index is not None:
+                self.index.release(self.fpath)
+            raise
+        if self.index is not None:
+            self._finish_indexed_file(temp_path)
+        else:
+            # Rename the written file from [fpath].part to [fpath]
+            os.rename(temp_path, self.fpath)
         self.written_files.append(self.fpath)
+        if self._scanner is not None:
+            self._scanner.close()
+            self.metadata[self.fpath] = self._scanner
 
-        # Use two buffers in case the boundary gets cut in half
-        buf1 = self._safe_read()
-        buf2 = self._safe_read()
-        with open(temp_path, "wb") as write_fp:
-            while self.boundary not in buf1 + buf2:
-                write_fp.write(buf1)
-                buf1 = buf2
-                buf2 = self._safe_read()
-            if self.bytes_left != 0:
-                # Catch the rest of the last line
-                remaining_lines = (
-                        buf1 + buf2 + self.fp.readline()).splitlines(True)
+    def _open_writer(self, out_fp):
+        """Return a context manager for the file object to write to"""
+        if self.throttle is None:
+            return contextlib.nullcontext(out_fp)
+        return self.throttle.writer(out_fp)
+
+    def _finish_indexed_file(self, temp_path):
+        """
+        Move the written file into place, unless a file with the same
+        content already exists.  In that case the temporary file is
+        discarded and self.fpath is pointed at the existing file, or at
+        a hardlink to it if the file was uploaded under a different name.
+        """
+        digest = self._hash.hexdigest()
+        existing = self.index.lookup(digest)
+        if existing is None:
+            os.rename(temp_path, self.fpath)
+            self.index.add(digest, self.fpath)
+            return
+        os.remove(temp_path)
+        if not self.index.is_same_name(existing, self._filename):
+            try:
+                os.link(existing, self.fpath)
+            except OSError:
+                pass # e.g. not supported by the file system
+            else:
+                logging.info("Linked duplicate upload %s to %s",
+                        self.fpath, existing)
+                self.index.add(digest, self.fpath)
+                return
+        logging.info("Reusing %s for duplicate upload", existing)
+        self.index.touch(existing)
+        self.index.release(self.fpath)
+        self.fpath = existing
+
+    def _write_data(self, write_fp, data):
+        """Write data to the file, decompressing it if necessary"""
+        if self._decompressor is None:
+            self._write_out(write_fp, data)
+            return
+        # Limit the output size so that memory usage stays bounded
+        # even for highly compressed data.
+        while data:
+            if self._decompressor.eof:
+                # A gzip file can consist of multiple members, e.g. when
+                # compressed files were concatenated
+                self._decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+            self._write_out(write_fp, self._decompressor.decompress(
+                data, self.DECOMPRESS_SIZE))
+            if self._decompressor.eof:
+                data = self._decompressor.unused_data
             else:
-                remaining_lines = (buf1 + buf2).splitlines(True)
-
-            # We need an exception for the last line of the file to strip
-            # the trailing "\r\n" (<CR><LF>)
-            prev_line = b""
-            # We take the index with us so we know where to pick up below
-            for i, line in enumerate(remaining_lines):
-                if self.boundary not in line:
-                    write_fp.write(prev_line)
-                    prev_line = line
-                else:
-                    # Now write the last line, but stripped
-                    write_fp.write(prev_line.rstrip(b"\r\n"))
-                    break
-        # Rename the written file from [fpath].part to [fpath]
-        os.rename(temp_path, self.fpath)
-
-        # Parse all other lines left in the buffer normally
-        # When reaching the end, StopIteration will be propagated up to parse()
-        for line in remaining_lines[i:]:
-            self._parse_line(line)
-
-    def _safe_read(self):
-        """Read a chunk that will not go past EOF"""
-        buflen = min(self.bytes_left, 1024)
-        self.bytes_left -= buflen
-        return self.fp.read(buflen)
+                data = self._decompressor.unconsumed_tail
+
+    def _write_out(self, write_fp, data):
+        """Write the final (decompressed) data of the file"""
+        if self.reservation is not None:
+            self.reservation.add(len(data))
+        write_fp.write(data)
+        if self._scanner is not None:
+            self._scanner.feed(data)
+        if self._hash is not None:
+            self._hash.update(data)
+
+    def _readline(self):
+        """Read a line, taking data left over from _write_file() first"""
+        if self._pending:
+            index = self._pending.find(b"\n") + 1
+            if index:
+                line = self._pending[:index]
+                self._pending = self._pending[index:]
+                return line
+            line = self._pending
+            self._pending = b""
+            return line + self._readline()
+        # Don't read past EOF.  readline(0) returns b""
+        # A line longer than a part can be is cut and fails later.
+        line = self.fp.readline(
+                max(min(self.bytes_left, self.max_part_size + 1), 0))
+        self.bytes_left -= len(line)
+        return line
+
+    def _readinto(self, view):
+        """Read into the memoryview, but not past EOF"""
+        if len(view) > self.bytes_left:
+            view = view[:max(self.bytes_left, 0)]
+        n = self.fp.readinto(view)
+        self.bytes_left -= n
+        return n
 
     def _start_body(self, headers):
         """Initiate reading of the body depending on whether it is a file"""
         name = headers.get_param("name", header="Content-Disposition")
         if name == "file":
-            self.fpath = os.path.join(self.out_dir, headers.get_filename())
-            if not self.overwrite:
+            filename = os.path.basename(headers.get_filename())
+            encoding = headers.get("Content-Encoding", "").strip().lower()
+            if filename.endswith(".gz"):
+                filename = filename[:-3]
+                encoding = "gzip"
+            if encoding in {"gzip", "x-gzip", "deflate"}:
+                # Automatically detect the gzip or zlib header
+                self._decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+            else:
+                self._decompressor = None
+            self._filename = filename
+            self.fpath = os.path.join(self.out_dir, filename)
+            if self.index is not None:
+                self.fpath = self.index.unique_path(self.fpath)
+            elif not self.overwrite:
                 self.fpath = self._unique_path(self.fpath)
             self._state = self.FILE
         else:
@@ -0,0 +1,130 @@
+from collections import Counter
+import cProfile
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+
+
+class Profiler:
+    """
+    Profile the server in the field, without attaching to klippy.
+
+    profile_requests(n) runs the next n requests under cProfile and
+    writes the combined statistics as a pstats file, to be viewed with
+    e.g. "python -m pstats FILE" or snakeviz.  Only one request is
+    profiled at a time, requests arriving meanwhile run as usual.
+
+    sample(seconds) records the stacks of all threads every
+    SAMPLE_INTERVAL seconds and writes them in the collapsed stack
+    format, one "thread;frame;...;frame count" per line, as read by
+    flamegraph.pl or speedscope.  This also catches time spent outside
+    of request handlers, e.g. waiting for the reactor or in the
+    StatusCollector.
+
+    All files are written to output_dir.
+    """
+
+    # Seconds between two stack samples
+    SAMPLE_INTERVAL = 0.005
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.active = False # Whether requests should be passed to run()
+        self._lock = threading.Lock()
+        self._profile_lock = threading.Lock()
+        self._remaining = 0
+        self._stats = None
+        self._output = None
+        self._sampler = None
+
+    def _output_path(self, kind, extension):
+        return os.path.join(self.output_dir, "cura_connection_{}_{}.{}".format(
+            kind, time.strftime("%Y%m%d-%H%M%S"), extension))
+
+    def profile_requests(self, count):
+        """
+        Profile the next count requests.  Return the path of the
+        pstats file that will be written.
+        """
+        with self._lock:
+            if self.active:
+                raise RuntimeError("Already profiling requests")
+            self._remaining = count
+            self._stats = None
+            self._output = self._output_path("profile", "pstats")
+            self.active = True
+            logging.info("Profiling the next %d requests", count)
+            return self._output
+
+    def run(self, func, *args, **kwargs):
+        """Call func, profiled if profile_requests() is active"""
+        # Newer Pythons only allow one active profiler at a time
+        if not self._profile_lock.acquire(blocking=False):
+            return func(*args, **kwargs)
+        try:
+            with self._lock:
+                profiled = self._remaining > 0
+                self._remaining -= profiled
+            if not profiled:
+                return func(*args, **kwargs)
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(func, *args, **kwargs)
+            finally:
+                self._add(profile)
+        finally:
+            self._profile_lock.release()
+
+    def _add(self, profile):
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+            if self._remaining <= 0:
+                self.active = False
+                self._stats.dump_stats(self._output)
+                logging.info("Wrote request profile to %s", self._output)
+                self._stats = None
+
+    def sample(self, seconds):
+        """
+        Sample the stacks of all threads for the given time in the
+        background.  Return the path of the file that will be written.
+        """
+        with self._lock:
+            if self._sampler is not None and self._sampler.is_alive():
+                raise RuntimeError("Already sampling")
+            output = self._output_path("stacks", "folded")
+            self._sampler = threading.Thread(target=self._sample,
+                    args=(seconds, output), name="Stack-Sampler", daemon=True)
+            self._sampler.start()
+            logging.info("Sampling stacks for %.0fs", seconds)
+            return output
+
+    def _sample(self, seconds, output):
+        stacks = Counter()
+        own_id = threading.get_ident()
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{} ({}:{})".format(code.co_name,
+                        os.path.basename(code.co_filename),
+                        code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stacks[";".join(reversed(stack))] += 1
+            time.sleep(self.SAMPLE_INTERVAL)
+        with open(output, "w") as fp:
+            for stack, count in stacks.most_common():
+                fp.write("{} {}\n".format(stack, count))
+        logging.info("Wrote stack samples to %s", output)
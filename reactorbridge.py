@@ -0,0 +1,103 @@
+from concurrent import futures
+import logging
+import time
+
+
+class ReactorTimeout(TimeoutError):
+    """Raised when klippy doesn't run a callback before its deadline"""
+
+
+def _timed_call(e, printer, func, args):
+    """Run func in the printer process and measure its execution time"""
+    start = time.monotonic()
+    result = func(e, printer, *args)
+    return result, time.monotonic() - start
+
+
+class ReactorBridge:
+    """
+    Run callbacks in the printer process without blocking the caller
+    indefinitely.  submit() returns a Future for the result of
+    reactor.cb(), call() waits for it with a deadline.  Callbacks that
+    haven't been dispatched to the reactor when their deadline passes
+    are cancelled; klippy can't abort a callback it has already
+    received.
+
+    The outcome, queueing and execution time of every callback are
+    recorded per function in the MetricsRegistry.  Queueing time is the
+    whole round trip minus the execution time: waiting for a bridge
+    worker, for the reactor and the transfer between the processes.
+    """
+
+    # Number of callbacks that can wait for the reactor at the same time
+    MAX_WORKERS = 4
+    # Callbacks taking longer than this many seconds are logged
+    SLOW_CALLBACK = 1
+
+    def __init__(self, reactor, metrics):
+        self.reactor = reactor
+        self.executor = futures.ThreadPoolExecutor(max_workers=self.MAX_WORKERS,
+                thread_name_prefix="Reactor-Bridge")
+        self._calls = metrics.counter("cura_reactor_callbacks_total",
+                "Reactor callbacks by result (ok, error, cancelled) and "
+                "missed deadlines (timeout)",
+                ("function", "result"))
+        self._queue_time = metrics.histogram("cura_reactor_queue_seconds",
+                "Time reactor callbacks spent waiting", ("function",))
+        self._exec_time = metrics.histogram("cura_reactor_exec_seconds",
+                "Time reactor callbacks spent executing in klippy",
+                ("function",))
+
+    def submit(self, func, *args):
+        """
+        Schedule func(e, printer, *args) to be run by the reactor and
+        return a concurrent.futures.Future of its result.
+        """
+        submitted = time.monotonic()
+        future = self.executor.submit(self._run, func, args, submitted)
+        future.add_done_callback(
+                lambda f: f.cancelled() and self._count(func, "cancelled"))
+        return future
+
+    def call(self, func, *args, timeout=None):
+        """
+        Run func(e, printer, *args) in the reactor and return its
+        result.  Raise ReactorTimeout if that takes more than timeout
+        seconds.
+        """
+        future = self.submit(func, *args)
+        try:
+            return future.result(timeout)
+        except futures.TimeoutError:
+            future.cancel()
+            self._count(func, "timeout")
+            raise ReactorTimeout("Klippy did not run {} in time".format(
+                self._name(func))) from None
+
+    def _run(self, func, args, submitted):
+        """Run in a worker thread, blocks until the reactor is done"""
+        try:
+            result, exec_time = self.reactor.cb(
+                    _timed_call, func, args, wait=True)
+        except Exception:
+            self._count(func, "error")
+            raise
+        total = time.monotonic() - submitted
+        name = self._name(func)
+        if total > self.SLOW_CALLBACK:
+            logging.warning("Slow reactor callback %s: %.2fs, %.2fs executing",
+                    name, total, exec_time)
+        self._calls.labels(name, "ok").inc()
+        self._queue_time.labels(name).observe(total - exec_time)
+        self._exec_time.labels(name).observe(exec_time)
+        return result
+
+    @staticmethod
+    def _name(func):
+        return getattr(func, "__qualname__", repr(func))
+
+    def _count(self, func, result):
+        self._calls.labels(self._name(func), result).inc()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,97 @@
+import re
+
+
+# Matches a single path segment that is a lowercase UUID
+UUID_REGEX = re.compile(r"[0-9a-f]{8}(?:-[0-9a-f]{4}){3}-[0-9a-f]{12}")
+
+
+class _Node:
+    """A path segment in the trie of parametrized routes"""
+
+    __slots__ = ("methods", "children", "param", "param_node")
+
+    def __init__(self):
+        self.methods = {} # HTTP method: function
+        self.children = {} # Literal segment: _Node
+        self.param = None # Name of the parameter matching any segment
+        self.param_node = None
+
+
+class Router:
+    """
+    Table of the routes of the HTTP API.  Routes are registered with
+    the route() decorator, e.g.
+
+        @router.route("DELETE", CLUSTER_API + "print_jobs/{uuid}")
+        def delete_print_job(self, uuid):
+
+    A segment in braces is a parameter, whose value is passed to the
+    function as keyword argument.  Only parameters with a pattern in
+    PARAMETERS are allowed, segments that don't match it are not found.
+
+    Routes without parameters are resolved with a single dictionary
+    lookup, the others by walking a trie of the path segments.
+    """
+
+    PARAMETERS = {
+        "uuid": UUID_REGEX,
+    }
+
+    def __init__(self):
+        self._static = {} # (method, path): function
+        self._root = _Node()
+
+    def route(self, method, path):
+        """Decorator registering a function for method and path"""
+        def decorator(func):
+            self.add(method, path, func)
+            return func
+        return decorator
+
+    def add(self, method, path, func):
+        if "{" not in path:
+            self._static[(method, path)] = func
+            return
+        node = self._root
+        for segment in path.split("/"):
+            if segment.startswith("{") and segment.endswith("}"):
+                name = segment[1:-1]
+                if name not in self.PARAMETERS:
+                    raise ValueError("Unknown route parameter: " + name)
+                if node.param_node is None:
+                    node.param = name
+                    node.param_node = _Node()
+                elif node.param != name:
+                    raise ValueError("Conflicting route parameters: {} and {}"
+                            .format(node.param, name))
+                node = node.param_node
+            else:
+                node = node.children.setdefault(segment, _Node())
+        if method in node.methods:
+            raise ValueError("Route already registered: {} {}".format(
+                method, path))
+        node.methods[method] = func
+
+    def resolve(self, method, path):
+        """
+        Return the function registered for method and path and a
+        dictionary of the parameters to call it with, or (None, None).
+        """
+        func = self._static.get((method, path))
+        if func is not None:
+            return func, {}
+        node = self._root
+        params = {}
+        for segment in path.split("/"):
+            child = node.children.get(segment)
+            if child is None:
+                if (node.param_node is None or not
+                        self.PARAMETERS[node.param].fullmatch(segment)):
+                    return None, None
+                params[node.param] = segment
+                child = node.param_node
+            node = child
+        func = node.methods.get(method)
+        if func is None:
+            return None, None
+        return func, params
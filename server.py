@@ -1,180 +1,370 @@
+import asyncio
+from concurrent import futures
+import errno
 from http import HTTPStatus
 import http.server as srv
+import io
 import json
 import logging
-import re
+import socket
 import threading
 import time
+import zlib
 
-from .mimeparser import MimeParser
+from .mimeparser import MimeParser, PayloadTooLarge
+from .reactorbridge import ReactorTimeout
+from .router import Router
+from .storagemanager import InsufficientStorage
 
 threading.excepthook = lambda *args: logging.exception("Exception in thread")
 
 PRINTER_API = "/api/v1/"
 CLUSTER_API = "/cluster-api/v1/"
 MJPG_STREAMER_PORT = 8080
+# Paths that files are uploaded to with POST
+UPLOAD_PATHS = frozenset({CLUSTER_API + "print_jobs/",
+                          CLUSTER_API + "materials/"})
+
+router = Router()
 
 
 class Handler(srv.BaseHTTPRequestHandler):
 
     """
-    Regex for a path in form:
-    /cluster-api/v1/print_jobs/<UUID>...
-    with the uuid and the suffix (everything past the uuid) in their
-    respective groups "uuid" and "suffix".
+    Implements the responses to the requests that we can expect from
+    Cura, for a summary of those see README.md.  Every request is passed
+    to the method registered for its path in the router.
     """
-    uuid_regex = re.compile(r"^" + CLUSTER_API + r"print_jobs/"
-            + r"(?P<uuid>[0-9a-f]{8}(?:-[0-9a-f]{4}){3}-[0-9a-f]{12})"
-            + r"(?P<suffix>.*)$")
 
     # Keeps TCP connections alive
     protocol_version = "HTTP/1.1"
+    # Seconds to wait for klippy before answering 503 Service Unavailable
+    REACTOR_TIMEOUT = 5
+    # Seconds after which the client should retry in that case
+    RETRY_AFTER = 2
+    # Seconds after which an idle event stream gets a keepalive comment
+    EVENTS_KEEPALIVE = 15
 
     def __init__(self, request, client_address, server):
         self.module = server.module
         self.reactor = server.module.reactor
         self.content_manager = self.module.content_manager
         self._size = None # For logging GET requests
+        self._route = None # Name of the method handling the request
         super().__init__(request, client_address, server)
 
-    def do_GET(self):
-        """
-        Implement a case-specific response, limited to the requests
-        that we can expect from Cura.  For a summary of those see
-        README.md
-        """
-        if self.path == CLUSTER_API + "printers":
-            self.get_json(self.content_manager.get_printer_status())
-        elif self.path == CLUSTER_API + "print_jobs":
-            self.get_json(self.content_manager.get_print_jobs())
-        elif self.path == CLUSTER_API + "materials":
-            self.get_json(self.content_manager.get_materials())
-        elif self.path == "/?action=stream":
-            self.get_stream()
-        elif self.path == "/?action=snapshot":
-            self.get_snapshot()
-        elif self.path == PRINTER_API + "system":
-            self.send_error(HTTPStatus.NOT_IMPLEMENTED)
-        else:
-            m = self.uuid_regex.match(self.path)
-            if m and m.group("suffix") == "/preview_image":
-                self.get_preview_image(m.group("uuid"))
-            else:
-                # NOTE: send_error() calls end_headers()
-                self.send_error(HTTPStatus.NOT_FOUND)
-
-    def do_POST(self):
-        if self.headers.get_content_maintype() == "multipart":
-            if self.path == CLUSTER_API + "print_jobs/":
-                self.post_print_job()
-            elif self.path == CLUSTER_API + "materials/":
-                self.post_material()
-        else:
-            m = self.uuid_regex.match(self.path)
-            if m and m.group("suffix") == "/action/move":
-                self.post_move_to_top(m.group("uuid"))
-            else:
-                self.send_error(HTTPStatus.NOT_FOUND)
-
-    def do_PUT(self):
-        m = self.uuid_regex.match(self.path)
-        if m and m.group("suffix") == "/action":
-            # pause, print or abort
-            self.put_action(m.group("uuid"))
-        elif m and not m.group("suffix"):
-            # force print job
-            self.put_force(m.group("uuid"))
-        else:
+    def dispatch(self):
+        """Call the method that is registered for the request"""
+        start = time.monotonic()
+        func, params = router.resolve(self.command, self.path)
+        if func is None:
+            self._route = "not_found"
+            # NOTE: send_error() calls end_headers()
             self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        self._route = func.__name__
+        try:
+            if self.module.profiler.active:
+                self.module.profiler.run(func, self, **params)
+            else:
+                func(self, **params)
+        except ReactorTimeout:
+            self.send_unavailable()
+        finally:
+            self.server.request_time.labels(self._route).observe(
+                    time.monotonic() - start)
 
-    def do_DELETE(self):
-        m = self.uuid_regex.match(self.path)
-        if m and not m.group("suffix"):
-            # Delete print job from queue
-            self.delete_print_job(m.group("uuid"))
-        else:
-            self.send_error(HTTPStatus.NOT_FOUND)
+    do_GET = do_POST = do_PUT = do_DELETE = dispatch
+
+    def handle_expect_100(self):
+        """
+        Called for requests with "Expect: 100-continue" before the body
+        is sent.  Uploads are checked here, so that the client doesn't
+        need to send the whole file only to have it rejected.
+        """
+        error = self.check_upload()
+        if error is not None:
+            self.send_error(*error)
+            return False
+        return srv.BaseHTTPRequestHandler.handle_expect_100(self)
 
-    def get_json(self, content):
-        """Send an object JSON-formatted"""
+    def check_upload(self):
+        """
+        Check the headers of an upload and whether there is enough space
+        for it.  Return a tuple of error code and message if the upload
+        can't be accepted, None otherwise.
+        """
+        if not self.is_upload():
+            return None
+        if (self.headers.get_content_maintype() != "multipart"
+                or not self.headers.get_boundary()):
+            return (HTTPStatus.BAD_REQUEST, "Expected multipart/form-data")
+        if "Content-Length" not in self.headers:
+            return (HTTPStatus.LENGTH_REQUIRED, None)
         try:
-            json_content = json.dumps(content)
-        except TypeError:
-            self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR,
-                    "JSON serialization failed")
-        else:
-            self.send_response(HTTPStatus.OK, size=len(json_content))
+            length = int(self.headers["Content-Length"])
+        except ValueError:
+            length = -1
+        if length < 0:
+            return (HTTPStatus.BAD_REQUEST, "Bad Content-Length")
+        if self.path == CLUSTER_API + "print_jobs/":
+            try:
+                self.module.storage_manager.make_room(length)
+            except InsufficientStorage as e:
+                return (HTTPStatus.INSUFFICIENT_STORAGE, str(e))
+        return None
+
+    def is_upload(self):
+        """Whether the request uploads a file"""
+        return self.command == "POST" and self.path in UPLOAD_PATHS
+
+    @router.route("GET", CLUSTER_API + "printers")
+    def get_printer_status(self):
+        snapshot = self.content_manager.get_snapshot()
+        self.get_resource(snapshot.printers,
+                age=time.monotonic() - snapshot.time)
+
+    @router.route("GET", CLUSTER_API + "print_jobs")
+    def get_print_jobs(self):
+        snapshot = self.content_manager.get_snapshot()
+        self.get_resource(snapshot.print_jobs,
+                age=time.monotonic() - snapshot.time)
+
+    @router.route("GET", CLUSTER_API + "materials")
+    def get_materials(self):
+        self.get_resource(self.content_manager.get_materials())
+
+    def get_resource(self, resource, age=None):
+        """
+        Send an already JSON-encoded Resource, or only 304 Not Modified
+        if the client already has this version.  If given, age is sent
+        as the Age header, the seconds since the content was fetched.
+        """
+        modified = not self._etag_matches(resource.etag)
+        if modified:
+            self.send_response(HTTPStatus.OK, size=len(resource.body))
             self.send_header("Content-Type", "application/json")
-            self.end_headers()
-            self.wfile.write(json_content.encode())
-
+        else:
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+        self.send_header("ETag", resource.etag)
+        if age is not None:
+            self.send_header("Age", str(int(age)))
+        self.end_headers()
+        if modified:
+            self.wfile.write(resource.body)
+
+    def _etag_matches(self, etag):
+        """Check etag against the If-None-Match header"""
+        header = self.headers.get("If-None-Match")
+        if header is None:
+            return False
+        for tag in header.split(","):
+            tag = tag.strip()
+            if tag == "*" or tag == etag or tag == "W/" + etag:
+                return True
+        return False
+
+    @router.route("GET", CLUSTER_API + "print_jobs/{uuid}/preview_image")
     def get_preview_image(self, uuid):
         """Send back the preview image for the print job with uuid"""
-        index, print_job = self.content_manager.uuid_to_print_job(uuid)
-        if not print_job:
+        job = self.content_manager.get_snapshot().jobs_by_uuid.get(uuid)
+        if job is None:
             self.send_error(HTTPStatus.NOT_FOUND, "Print job not in Queue")
         else:
             try:
-                thumbnail_path = self.module.get_thumbnail_path(
-                        index, print_job.name)
-                with open(thumbnail_path, "rb") as fp:
-                    image_data = fp.read()
+                image_data = self.content_manager.get_preview_image(job)
+            except IOError as e:
+                self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR,
+                        "Failed to open preview image: " + str(e))
+            else:
                 self.send_response(HTTPStatus.OK, size=len(image_data))
                 self.send_header("Content-Type", "image/png")
                 self.end_headers()
                 self.wfile.write(image_data)
-            except IOError:
-                self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR,
-                        "Failed to open preview image at " + thumbnail_path)
 
+    @router.route("GET", "/metrics")
+    def get_metrics(self):
+        """Send all metrics in the Prometheus text format"""
+        body = self.module.metrics.render().encode()
+        self.send_response(HTTPStatus.OK, size=len(body))
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.end_headers()
+        self.wfile.write(body)
+
+    @router.route("GET", CLUSTER_API + "events")
+    def get_events(self):
+        """
+        Stream changes of the printer and the print jobs as Server-Sent
+        Events, see EventStream.  This keeps the handler busy until the
+        client disconnects.  AsyncHandler serves the stream from the
+        event loop instead.
+        """
+        events = self.content_manager.events
+        with events.subscription():
+            self.start_event_stream()
+            last_id = self.headers.get("Last-Event-ID")
+            while True:
+                data, last_id = events.read(last_id)
+                if data is None: # Shutting down
+                    break
+                self.wfile.write(data or events.KEEPALIVE)
+                self.wfile.flush()
+                events.wait(last_id, self.EVENTS_KEEPALIVE)
+
+    def start_event_stream(self):
+        """Send the headers of an event stream"""
+        self.close_connection = True
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        # Updates might be paused while nobody polled
+        self.content_manager.refresh()
+
+    @router.route("POST", "/debug/profile")
+    def post_profile(self):
+        """
+        Start profiling, only available with DEBUG.  Expects either
+        {"requests": N} to profile the next N requests or
+        {"seconds": T} to sample all stacks for T seconds.  Returns the
+        path of the output file, which is written once done.
+        """
+        if not self.module.DEBUG:
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        rdata = self.rfile.read(length)
+        try:
+            data = json.loads(rdata)
+        except ValueError:
+            self.send_error(HTTPStatus.BAD_REQUEST, "Failed to read JSON")
+            return
+        requests = data.get("requests") if isinstance(data, dict) else None
+        seconds = data.get("seconds") if isinstance(data, dict) else None
+        try:
+            if isinstance(requests, int) and 0 < requests <= 10000:
+                output = self.module.profiler.profile_requests(requests)
+            elif isinstance(seconds, (int, float)) and 0 < seconds <= 600:
+                output = self.module.profiler.sample(seconds)
+            else:
+                self.send_error(HTTPStatus.BAD_REQUEST,
+                        "Expected {\"requests\": N} or {\"seconds\": T}")
+                return
+        except RuntimeError as e:
+            self.send_error(HTTPStatus.CONFLICT, str(e))
+            return
+        body = json.dumps({"output": output}).encode()
+        self.send_response(HTTPStatus.ACCEPTED, size=len(body))
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(body)
+
+    @router.route("GET", "/debug/memory")
+    def get_memory(self):
+        """
+        Send memory usage and, if allocations are traced, the sites
+        with the most growth.  Only available with DEBUG.
+        """
+        if not self.module.DEBUG:
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        body = json.dumps(self.module.memory_watchdog.report()).encode()
+        self.send_response(HTTPStatus.OK, size=len(body))
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(body)
+
+    @router.route("GET", "/?action=stream")
     def get_stream(self):
         """Redirect to the port on which mjpg-streamer is running"""
-        self.send_response(HTTPStatus.FOUND)
+        self.send_response(HTTPStatus.FOUND, size=0)
         self.send_header("Location", "http://{}:{}/?action=stream".format(
             self.module.ADDRESS, MJPG_STREAMER_PORT))
         self.end_headers()
 
+    @router.route("GET", "/?action=snapshot")
     def get_snapshot(self):
         """Snapshot only sends a single image"""
-        self.send_response(HTTPStatus.FOUND)
+        self.send_response(HTTPStatus.FOUND, size=0)
         self.send_header("Location", "http://{}:{}/?action=snapshot".format(
             self.module.ADDRESS, MJPG_STREAMER_PORT))
         self.end_headers()
 
+    @router.route("GET", PRINTER_API + "system")
+    def get_system(self):
+        self.send_error(HTTPStatus.NOT_IMPLEMENTED)
+
+    @router.route("POST", CLUSTER_API + "print_jobs/")
     def post_print_job(self):
+        if self.headers.get_content_maintype() != "multipart":
+            self.send_error(HTTPStatus.BAD_REQUEST,
+                    "Expected multipart/form-data")
+            return
         boundary = self.headers.get_boundary()
         length = int(self.headers.get("Content-Length", 0))
         try:
-            parser = MimeParser(self.rfile, boundary, length,
-                self.module.SDCARD_PATH, overwrite=False)
-            submessages, paths = parser.parse()
+            with self.module.storage_manager.upload(length) as reservation:
+                parser = MimeParser(self.rfile, boundary, length,
+                    self.module.SDCARD_PATH, overwrite=False, scan_gcode=True,
+                    index=self.module.upload_index,
+                    throttle=self.module.upload_throttle,
+                    reservation=reservation)
+                submessages, paths = parser.parse()
+                owner = None
+                for msg in submessages:
+                    name = msg.get_param("name", header="Content-Disposition")
+                    if name == "owner":
+                        owner = msg.get_payload().strip()
+                for path in paths:
+                    self.content_manager.add_upload(
+                            path, parser.metadata[path], owner)
+                    self.reactor.cb(self.module.add_print, path)
+        except PayloadTooLarge as e:
+            self.send_error(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, str(e))
+        except zlib.error as e:
+            self.send_error(HTTPStatus.BAD_REQUEST,
+                    "Failed to decompress file: " + str(e))
+        except socket.timeout as e:
+            self.send_error(HTTPStatus.REQUEST_TIMEOUT, str(e))
         except Exception as e:
-            self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR,
-                    "Parser failed: " + str(e))
+            # Raised by StorageManager or while writing the file
+            if isinstance(e, OSError) and e.errno == errno.ENOSPC:
+                self.send_error(HTTPStatus.INSUFFICIENT_STORAGE, str(e))
+            else:
+                self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR,
+                        "Parser failed: " + str(e))
         else:
-            #for msg in submessages:
-            #    name = msg.get_param("name", header="Content-Disposition")
-            #    if name == "owner":
-            #        owner = msg.get_payload().strip()
-            for path in paths:
-                self.reactor.cb(self.module.add_print, path)
-            self.send_response(HTTPStatus.OK)
+            self.content_manager.refresh()
+            self.send_response(HTTPStatus.OK, size=0)
             self.end_headers()
 
+    @router.route("POST", CLUSTER_API + "materials/")
     def post_material(self):
+        if self.headers.get_content_maintype() != "multipart":
+            self.send_error(HTTPStatus.BAD_REQUEST,
+                    "Expected multipart/form-data")
+            return
         boundary = self.headers.get_boundary()
         length = int(self.headers.get("Content-Length", 0))
         try:
             parser = MimeParser(self.rfile, boundary, length,
                     self.module.MATERIAL_PATH)
             submessages, paths = parser.parse()
+        except PayloadTooLarge as e:
+            self.send_error(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, str(e))
+        except zlib.error as e:
+            self.send_error(HTTPStatus.BAD_REQUEST,
+                    "Failed to decompress file: " + str(e))
+        except socket.timeout as e:
+            self.send_error(HTTPStatus.REQUEST_TIMEOUT, str(e))
         except Exception as e:
             self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR,
                     "Parser failed: " + str(e))
         else:
             self.reactor.cb(self.read_material_file, paths[0])
             # Reply is checked specifically for 200
-            self.send_response(HTTPStatus.OK)
+            self.send_response(HTTPStatus.OK, size=0)
             self.end_headers()
 
     @staticmethod
@@ -184,6 +374,7 @@ class Handler(srv.BaseHTTPRequestHandler):
         fm.cached_parse.cache_clear()
         fm.read_single_file(path)
 
+    @router.route("POST", CLUSTER_API + "print_jobs/{uuid}/action/move")
     def post_move_to_top(self, uuid):
         """Move print job with uuid to the top of the queue"""
         length = int(self.headers.get("Content-Length", 0))
@@ -193,33 +384,38 @@ class Handler(srv.BaseHTTPRequestHandler):
         except ValueError:
             self.send_error(HTTPStatus.BAD_REQUEST, "Failed to read JSON")
             return
-        old_index, _ = self.content_manager.uuid_to_print_job(uuid)
+        job = self.content_manager.get_snapshot().jobs_by_uuid.get(uuid)
         new_index = data.get("to_position")
-        if old_index is None:
+        if job is None:
             self.send_error(HTTPStatus.NOT_FOUND, "Print job not in Queue")
         elif data.get("list") != "queued" or not isinstance(new_index, int):
             self.send_error(HTTPStatus.BAD_REQUEST,
                     "Unexpected JSON content: " + rdata)
         else:
-            if self.reactor.cb(self.module.queue_move,
-                    old_index, uuid, new_index-old_index, wait=True):
-                self.send_response(HTTPStatus.OK)
+            if self.call_reactor(self.module.queue_move, job.index,
+                    job.klippy_uuid, new_index-job.index):
+                self.content_manager.refresh()
+                self.send_response(HTTPStatus.OK, size=0)
                 self.end_headers()
             else:
                 self.send_error(HTTPStatus.CONFLICT, "Queue order has changed")
 
+    @router.route("DELETE", CLUSTER_API + "print_jobs/{uuid}")
     def delete_print_job(self, uuid):
         """Delete print job with uuid from the queue"""
-        index, print_job = self.content_manager.uuid_to_print_job(uuid)
-        if not print_job:
+        job = self.content_manager.get_snapshot().jobs_by_uuid.get(uuid)
+        if job is None:
             self.send_error(HTTPStatus.NOT_FOUND, "Print job not in queue")
         else:
-            if self.reactor.cb(self.module.queue_delete, index, uuid, wait=True):
-                self.send_response(HTTPStatus.OK)
+            if self.call_reactor(self.module.queue_delete,
+                    job.index, job.klippy_uuid):
+                self.content_manager.refresh()
+                self.send_response(HTTPStatus.OK, size=0)
                 self.end_headers()
             else:
                 self.send_error(HTTPStatus.CONFLICT, "Queue order has changed")
 
+    @router.route("PUT", CLUSTER_API + "print_jobs/{uuid}/action")
     def put_action(self, uuid):
         """
         Pause, Print or Abort a print job.
@@ -232,27 +428,32 @@ class Handler(srv.BaseHTTPRequestHandler):
         except ValueError:
             self.send_error(HTTPStatus.BAD_REQUEST, "Failed to read JSON")
             return
-        index, print_job = self.content_manager.uuid_to_print_job(uuid)
+        job = self.content_manager.get_snapshot().jobs_by_uuid.get(uuid)
         action = data.get("action")
-        if not print_job:
+        if job is None:
             self.send_error(HTTPStatus.NOT_FOUND, "Print job not in Queue")
-        elif index != 0: # This request is only handled for the current print
+        elif job.index != 0: # Only handled for the current print
             self.send_error(HTTPStatus.BAD_REQUEST,
-                    "Can only operate on current print job. Got " + str(index))
+                "Can only operate on current print job. Got " + str(job.index))
         else:
-            res = True
             if action == "print":
-                res = self.reactor.cb(self.module.resume_print, uuid, wait=True)
+                func = self.module.resume_print
             elif action == "pause":
-                res = self.reactor.cb(self.module.pause_print, uuid, wait=True)
+                func = self.module.pause_print
             elif action == "abort":
-                res = self.reactor.cb(self.module.stop_print, uuid, wait=True)
+                func = self.module.stop_print
             else:
                 self.send_error(HTTPStatus.BAD_REQUEST, "Unknown action: " + str(action))
-            if not res:
+                return
+            if self.call_reactor(func, job.klippy_uuid):
+                self.content_manager.refresh()
+                self.send_response(HTTPStatus.OK, size=0)
+                self.end_headers()
+            else:
                 self.send_error(HTTPStatus.CONFLICT,
                     "Failed to " + str(action) + ", queue order has changed")
 
+    @router.route("PUT", CLUSTER_API + "print_jobs/{uuid}")
     def put_force(self, uuid):
         """
         Force a print job that requires configuration change
@@ -266,8 +467,8 @@ class Handler(srv.BaseHTTPRequestHandler):
         except ValueError:
             self.send_error(HTTPStatus.BAD_REQUEST, "Failed to read JSON")
             return
-        index, print_job = self.content_manager.uuid_to_print_job(uuid)
-        if not print_job:
+        job = self.content_manager.get_snapshot().jobs_by_uuid.get(uuid)
+        if job is None:
             self.send_error(HTTPStatus.NOT_FOUND, "Print job not in Queue")
         elif data.get("force") is not True:
             self.send_error(HTTPStatus.BAD_REQUEST,
@@ -276,6 +477,29 @@ class Handler(srv.BaseHTTPRequestHandler):
             self.send_error(HTTPStatus.NOT_IMPLEMENTED)
 
 
+    def parse_request(self):
+        # The handler is reused for all requests on a connection
+        self._size = None
+        self._route = None
+        return srv.BaseHTTPRequestHandler.parse_request(self)
+
+    def call_reactor(self, func, *args):
+        """
+        Run func(e, printer, *args) in klippy and return the result.
+        Raise ReactorTimeout if klippy doesn't answer within
+        REACTOR_TIMEOUT seconds.
+        """
+        return self.module.reactor_bridge.call(func, *args,
+                timeout=self.REACTOR_TIMEOUT)
+
+    def send_unavailable(self):
+        """Tell the client that klippy is busy and when to try again"""
+        self.log_error("code %d, message %s",
+                HTTPStatus.SERVICE_UNAVAILABLE, "Klippy is not responding")
+        self.send_response(HTTPStatus.SERVICE_UNAVAILABLE, size=0)
+        self.send_header("Retry-After", str(self.RETRY_AFTER))
+        self.end_headers()
+
     def send_response(self, code, message=None, size=None):
         """
         Accept size as an argument (can be int or str) which sends the
@@ -287,6 +511,7 @@ class Handler(srv.BaseHTTPRequestHandler):
         # Keep track of when the last request was handled
         # send_error() also calls here
         self.server.last_request = time.time()
+        self.server.responses.labels(self._route or "none", int(code)).inc()
         if self._size is not None:
             self.send_header("Content-Length", self._size)
 
@@ -307,6 +532,18 @@ class Handler(srv.BaseHTTPRequestHandler):
         logging.log(logging.INFO, "<%s> " + format, self.address_string(), *args)
 
 
+def register_metrics(server):
+    """Create the metrics updated by the Handler on server"""
+    metrics = server.module.metrics
+    server.responses = metrics.counter("cura_http_responses_total",
+            "HTTP responses sent", ("route", "code"))
+    server.request_time = metrics.histogram(
+            "cura_http_request_duration_seconds",
+            "Time to handle a request", ("route",))
+    metrics.gauge("cura_http_connections", "Open HTTP connections",
+            function=lambda: server.connections)
+
+
 class Server(srv.ThreadingHTTPServer, threading.Thread):
     """Wrapper class to store the module in the server and add threading"""
     def __init__(self, server_address, RequestHandler, module):
@@ -314,9 +551,345 @@ class Server(srv.ThreadingHTTPServer, threading.Thread):
         threading.Thread.__init__(self, name="Server-Thread")
         self.module = module
         self.last_request = 0 # Time of last request in seconds since epoch
+        self.connections = 0 # Number of currently open connections
+        self._connections_lock = threading.Lock()
+        register_metrics(self)
 
     run = srv.HTTPServer.serve_forever
 
+    def process_request(self, request, client_address):
+        with self._connections_lock:
+            self.connections += 1
+        super().process_request(request, client_address)
+
+    def shutdown_request(self, request):
+        """Called when a connection is closed"""
+        with self._connections_lock:
+            self.connections -= 1
+        super().shutdown_request(request)
+
+
+class AsyncHandler(Handler):
+
+    """
+    Handler for the AsyncServer.  A new instance is created for every
+    request.  The request line and headers are read on the event loop
+    and parsed by the inherited machinery, the do_* methods are then
+    run in a worker thread where they can block as usual.  rfile and
+    wfile are replaced with wrappers around the asyncio streams.
+    """
+
+    def __init__(self, reader, writer, server):
+        self.module = server.module
+        self.reactor = server.module.reactor
+        self.content_manager = self.module.content_manager
+        self._size = None
+        self._route = None
+        self.server = server
+        self.request = None
+        self.client_address = writer.get_extra_info("peername")
+        self._reader = reader
+        self._body = None
+        self._expect_100 = False
+        self.rfile = None
+        self.wfile = _StreamWriterFile(writer, server.loop, server.IO_TIMEOUT)
+
+    async def handle_async(self, head):
+        """
+        Handle a single request whose request line and headers are
+        given in head.  Return whether the connection should be kept
+        open for further requests.
+        """
+        self.rfile = io.BytesIO(head)
+        self.raw_requestline = self.rfile.readline(65537)
+        if not self.parse_request():
+            # An error response (or nothing) has been written
+            await self.wfile.drain()
+            return False
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            self.send_error(HTTPStatus.BAD_REQUEST, "Bad Content-Length")
+            await self.wfile.drain()
+            return False
+        # Only uploads can take long to read, everything else, e.g.
+        # pausing a print, must not have to wait for them
+        executor = (self.server.upload_executor if self.is_upload()
+                    else self.server.executor)
+        if self._expect_100:
+            # Checking the upload can block, e.g. while making room
+            if not await self.server.loop.run_in_executor(
+                    executor, Handler.handle_expect_100, self):
+                await self.wfile.drain()
+                return False
+            # Sends out "100 Continue"
+            await self.wfile.drain()
+        self._body = _StreamReaderRaw(self._reader, self.server.loop, length,
+                self.server.IO_TIMEOUT)
+        self.rfile = io.BufferedReader(self._body, self.server.READ_BUFFER)
+
+        func, params = router.resolve(self.command, self.path)
+        if func is not None and hasattr(self, func.__name__ + "_async"):
+            # Long-lived responses that shouldn't occupy a worker thread
+            self._route = func.__name__
+            await getattr(self, func.__name__ + "_async")(**params)
+            return False
+
+        method = getattr(self, "do_" + self.command, None)
+        if method is None:
+            self.send_error(HTTPStatus.NOT_IMPLEMENTED,
+                    "Unsupported method (%r)" % self.command)
+            await self.wfile.drain()
+            return False
+        await self.server.loop.run_in_executor(executor, self._run, method)
+        # A body that wasn't read completely can't be told apart from the
+        # next request
+        return not self.close_connection and self._body.remaining == 0
+
+    def handle_expect_100(self):
+        """
+        Called by parse_request() on the event loop, where the upload
+        can't be checked.  handle_async() does that in a worker instead.
+        """
+        self._expect_100 = True
+        return True
+
+    async def get_events_async(self):
+        """Like Handler.get_events(), without blocking a thread"""
+        events = self.content_manager.events
+        wakeup = asyncio.Event()
+        loop = self.server.loop
+        with events.subscription(
+                lambda: loop.call_soon_threadsafe(wakeup.set)):
+            self.start_event_stream()
+            last_id = self.headers.get("Last-Event-ID")
+            while True:
+                wakeup.clear()
+                data, last_id = events.read(last_id)
+                if data is None: # Shutting down
+                    break
+                self.wfile.write(data or events.KEEPALIVE)
+                await self.wfile.drain()
+                try:
+                    await asyncio.wait_for(wakeup.wait(),
+                            self.EVENTS_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    pass
+
+    def _run(self, method):
+        """Run the do_* method in a worker thread and send the response"""
+        try:
+            method()
+        except ConnectionError:
+            self.close_connection = True
+        except socket.timeout:
+            self.log_error("Request timed out")
+            self.close_connection = True
+        except Exception:
+            logging.exception("Exception while handling request")
+            self.close_connection = True
+        try:
+            self.wfile.flush()
+        except (ConnectionError, socket.timeout):
+            self.close_connection = True
+
+
+def _run_threadsafe(coro, loop, timeout):
+    """
+    Run coro on loop from a worker thread and return its result.  Raise
+    socket.timeout if that takes longer than timeout seconds and
+    ConnectionAbortedError if it is cancelled because of a shutdown.
+    """
+    future = asyncio.run_coroutine_threadsafe(
+            asyncio.wait_for(coro, timeout), loop)
+    try:
+        return future.result()
+    except futures.TimeoutError:
+        raise socket.timeout("Client did not respond in time") from None
+    except futures.CancelledError:
+        raise ConnectionAbortedError("Server is shutting down") from None
+
+
+class _StreamReaderRaw(io.RawIOBase):
+    """
+    Blocking, raw file object reading up to length bytes from an
+    asyncio.StreamReader.  Must not be used from within the event loop.
+    Every read raises socket.timeout after timeout seconds.
+    """
+
+    def __init__(self, reader, loop, length, timeout):
+        super().__init__()
+        self._reader = reader
+        self._loop = loop
+        self._timeout = timeout
+        self.remaining = length
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        size = min(len(b), self.remaining)
+        if size <= 0:
+            return 0
+        data = _run_threadsafe(self._reader.read(size), self._loop,
+                self._timeout)
+        if not data:
+            raise ConnectionResetError("Connection closed while reading body")
+        n = len(data)
+        b[:n] = data
+        self.remaining -= n
+        return n
+
+
+class _StreamWriterFile:
+    """
+    Buffer everything written and only pass it on to the
+    asyncio.StreamWriter with flush() (from a worker thread) or
+    drain() (from within the event loop).  flush() raises socket.timeout
+    if the client doesn't take the data within timeout seconds.
+    """
+
+    def __init__(self, writer, loop, timeout):
+        self._writer = writer
+        self._loop = loop
+        self._timeout = timeout
+        self._buffer = []
+
+    def write(self, data):
+        self._buffer.append(data)
+        return len(data)
+
+    def flush(self):
+        _run_threadsafe(self.drain(), self._loop, self._timeout)
+
+    async def drain(self):
+        if self._buffer:
+            self._writer.writelines(self._buffer)
+            self._buffer = []
+        await self._writer.drain()
+
+
+class AsyncServer(threading.Thread):
+    """
+    Drop-in replacement for Server that handles all connections on a
+    single asyncio event loop.  Idle keep-alive connections only cost a
+    coroutine instead of a whole thread.  Because request handlers still
+    block (e.g. while waiting on the reactor) they are run in a small,
+    fixed pool of worker threads.  Uploads get a pool of their own, so
+    that slow or stalled uploads can't keep other requests, like status
+    polls or pausing a print, from being answered.
+    """
+
+    # Connections beyond this are answered with 503 and closed
+    MAX_CONNECTIONS = 32
+    # Number of requests that can be handled at the same time, not
+    # counting uploads
+    MAX_WORKERS = 4
+    # Number of uploads that can be handled at the same time
+    UPLOAD_WORKERS = 2
+    # Seconds a worker waits for the client to send or receive data
+    IO_TIMEOUT = 30
+    # Seconds an idle keep-alive connection is kept open
+    KEEPALIVE_TIMEOUT = 120
+    # Maximum size of the request line and headers
+    HEADER_LIMIT = 65536
+    READ_BUFFER = 65536
+
+    def __init__(self, server_address, RequestHandler, module):
+        super().__init__(name="Server-Thread")
+        self.server_address = server_address
+        self.RequestHandlerClass = RequestHandler
+        self.module = module
+        self.last_request = 0 # Time of last request in seconds since epoch
+        self.connections = 0 # Number of currently open connections
+
+        # Bind right away, just like the socketserver classes
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(server_address)
+        self.socket.listen()
+
+        self.loop = asyncio.new_event_loop()
+        self.executor = futures.ThreadPoolExecutor(self.MAX_WORKERS,
+                thread_name_prefix="Server-Worker")
+        self.upload_executor = futures.ThreadPoolExecutor(self.UPLOAD_WORKERS,
+                thread_name_prefix="Server-Upload")
+        self._tasks = set()
+        self._shutdown_request = self.loop.create_future()
+        register_metrics(self)
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._serve())
+        finally:
+            self.loop.close()
+
+    def shutdown(self):
+        """Stop the server, can be called from any thread"""
+        def stop():
+            if not self._shutdown_request.done():
+                self._shutdown_request.set_result(None)
+        self.loop.call_soon_threadsafe(stop)
+
+    async def _serve(self):
+        server = await asyncio.start_server(self._handle_connection,
+                sock=self.socket, limit=self.HEADER_LIMIT)
+        try:
+            await self._shutdown_request
+        finally:
+            server.close()
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            # Reads and writes that workers are still waiting for
+            for task in asyncio.all_tasks():
+                if task is not asyncio.current_task():
+                    task.cancel()
+            await server.wait_closed()
+            # The loop must keep running until no worker can use it anymore
+            for executor in (self.executor, self.upload_executor):
+                await self.loop.run_in_executor(None, executor.shutdown)
+            await self.loop.shutdown_default_executor()
+
+    async def _handle_connection(self, reader, writer):
+        if self.connections >= self.MAX_CONNECTIONS:
+            logging.warning("Refusing connection from %s: Too many connections",
+                    writer.get_extra_info("peername")[0])
+            writer.write(b"HTTP/1.1 503 Service Unavailable\r\n"
+                         b"Content-Length: 0\r\nConnection: close\r\n\r\n")
+            writer.close()
+            return
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        self.connections += 1
+        try:
+            while await self._handle_request(reader, writer):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError,
+                asyncio.CancelledError): # Cancelled on shutdown
+            pass
+        finally:
+            self.connections -= 1
+            self._tasks.discard(task)
+            writer.close()
+
+    async def _handle_request(self, reader, writer):
+        """Read and handle one request, return whether to keep going"""
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"),
+                    self.KEEPALIVE_TIMEOUT)
+        except asyncio.TimeoutError:
+            return False
+        except asyncio.LimitOverrunError:
+            writer.write(b"HTTP/1.1 431 Request Header Fields Too Large\r\n"
+                         b"Content-Length: 0\r\nConnection: close\r\n\r\n")
+            return False
+        handler = self.RequestHandlerClass(reader, writer, self)
+        return await handler.handle_async(head)
+
 
 def get_server(module):
-    return Server((module.ADDRESS, 8008), Handler, module)
+    if module.SERVER_MODE == "threading":
+        return Server((module.ADDRESS, 8008), Handler, module)
+    return AsyncServer((module.ADDRESS, 8008), AsyncHandler, module)
@@ -0,0 +1,61 @@
+import threading
+import time
+
+
+class _Call:
+    """A single computation, shared by all callers with the same key"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.expires = None # Set when done
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls that compute the same thing.  While a
+    call for a key is running, other calls with the same key wait for it
+    and get the same result (or exception) instead of computing it
+    again.  The result is also reused for max_age seconds after the
+    call finished.  Expired results are dropped with the next call that
+    starts a computation, whatever its key.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args, max_age=0):
+        """Return func(*args), or the result of a call with the same key"""
+        now = time.monotonic()
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None or (call.expires is not None
+                                      and call.expires < now)
+            if leader:
+                self._prune(now)
+                call = self._calls[key] = _Call()
+        if leader:
+            try:
+                call.result = func(*args)
+            except BaseException as e:
+                call.error = e
+            with self._lock:
+                call.expires = time.monotonic() + max_age
+                # Don't keep errors or results that are already stale
+                if ((call.error is not None or max_age <= 0)
+                        and self._calls.get(key) is call):
+                    del self._calls[key]
+            call.done.set()
+        else:
+            call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def _prune(self, now):
+        """Remove expired calls, must be called with the lock held"""
+        for key, call in list(self._calls.items()):
+            if call.expires is not None and call.expires < now:
+                del self._calls[key]
@@ -0,0 +1,56 @@
+import logging
+import threading
+
+from .reactorbridge import ReactorTimeout
+
+
+class StatusCollector(threading.Thread):
+    """
+    Thread that periodically fetches the state of the printer and the
+    queue from klippy via ContentManager.update(), so that request
+    handlers only ever need to read the last published snapshot.
+
+    Updates are paused while no client is connected (see
+    CuraConnectionModule.is_connected()) and happen more often while
+    printing.  refresh() requests an immediate update, e.g. after the
+    queue was changed or when a client connects again.
+    """
+
+    # Seconds between updates
+    PRINTING_INTERVAL = 1
+    IDLE_INTERVAL = 2
+
+    def __init__(self, content_manager):
+        super().__init__(name="Collector-Thread", daemon=True)
+        self.content_manager = content_manager
+        self.module = content_manager.module
+        self._wakeup = threading.Event()
+        self._running = True
+
+    def run(self):
+        forced = True # Always get an initial snapshot
+        while self._running:
+            if forced or self.module.is_connected():
+                try:
+                    self.content_manager.update()
+                except ReactorTimeout:
+                    logging.warning("Klippy is busy, skipping status update")
+                except Exception:
+                    logging.exception("Failed to update printer status")
+                if self.content_manager.is_printing():
+                    timeout = self.PRINTING_INTERVAL
+                else:
+                    timeout = self.IDLE_INTERVAL
+            else:
+                # Nobody is asking, sleep until refresh() is called
+                timeout = None
+            forced = self._wakeup.wait(timeout)
+            self._wakeup.clear()
+
+    def refresh(self):
+        """Wake up the thread to update as soon as possible"""
+        self._wakeup.set()
+
+    def stop(self):
+        self._running = False
+        self._wakeup.set()
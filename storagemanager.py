@@ -0,0 +1,186 @@
+import contextlib
+import errno
+import logging
+import os
+import threading
+import time
+
+from .reactorbridge import ReactorTimeout
+
+class InsufficientStorage(OSError):
+    """
+    Raised when there is not enough space left for an upload,
+    with errno ENOSPC like a failed write.
+    """
+
+
+class StorageManager:
+    """
+    Keep the space used by uploaded print jobs in SDCARD_PATH in check.
+
+    Before an upload is accepted, the free space on the file system is
+    checked against its Content-Length.  If there isn't enough space or
+    the uploaded files would exceed BUDGET, the least recently used
+    uploads are deleted until there is.  Only files known to the
+    UploadIndex are considered, never the files queued in
+    virtual_sdcard or files of uploads that are still in progress.
+
+    Compressed uploads can write much more than their Content-Length,
+    so the written bytes are counted against the reservation, which is
+    extended by at least GROW_SIZE whenever it is exceeded.
+    """
+
+    # Maximum total size in bytes of all uploaded files
+    BUDGET = 4 * 1024**3
+    # Space in bytes to leave free on the file system in any case
+    RESERVED_SPACE = 64 * 1024**2
+    # Seconds to wait for klippy to list the queued files
+    QUEUE_TIMEOUT = 5
+    # Minimum bytes by which to extend an exceeded reservation
+    GROW_SIZE = 64 * 1024**2
+
+    def __init__(self, module):
+        self.module = module
+        self.directory = module.SDCARD_PATH
+        self.index = module.upload_index
+        self._lock = threading.Lock()
+        # Start times of uploads in progress, files modified after the
+        # earliest of them might not be queued yet.
+        self._active = {}
+
+    @contextlib.contextmanager
+    def upload(self, length):
+        """
+        Context manager for the whole upload of length bytes, up to
+        adding the written files to the queue.  Raises
+        InsufficientStorage if there is not enough space for it.
+        Yields a Reservation that the written bytes are added to.
+        """
+        reservation = Reservation(self, length)
+        with self._lock:
+            self._make_room(length)
+            self._active[reservation] = time.time()
+        try:
+            yield reservation
+        finally:
+            with self._lock:
+                del self._active[reservation]
+
+    def _extend(self, reservation):
+        """Make room for the bytes written beyond a reservation"""
+        extra = max(reservation.written - reservation.reserved,
+                    self.GROW_SIZE)
+        with self._lock:
+            self._make_room(extra, reservation.written)
+        reservation.reserved = reservation.written + extra
+
+    def make_room(self, length):
+        """
+        Make sure that length bytes can be uploaded, raise
+        InsufficientStorage if that isn't possible.  Used to check an
+        upload before its body is sent.
+        """
+        with self._lock:
+            self._make_room(length)
+
+    def free_space(self):
+        """Bytes available to unprivileged users on the file system"""
+        st = os.statvfs(self.directory)
+        return st.f_bavail * st.f_frsize
+
+    def used_space(self):
+        """Total size of all uploaded files, counting hardlinks once"""
+        sizes = {}
+        for path, _, _ in self.index.files():
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            sizes[(st.st_dev, st.st_ino)] = st.st_size
+        return sum(sizes.values())
+
+    def _make_room(self, length, written=0):
+        """
+        Evict uploads to fit length more bytes, must be called with the
+        lock held.  written are the bytes of the upload that are already
+        on disk, but not indexed yet.
+        """
+        missing = self.RESERVED_SPACE + length - self.free_space()
+        over_budget = self.used_space() + written + length - self.BUDGET
+        if max(missing, over_budget) > 0:
+            freed = self._evict(max(missing, over_budget))
+            missing -= freed
+        if missing > 0:
+            raise InsufficientStorage(errno.ENOSPC,
+                    "Not enough space for upload of {} bytes".format(length))
+
+    def _evict(self, amount):
+        """
+        Delete the least recently used uploads that aren't queued
+        until at least amount bytes are freed.  Return the freed bytes.
+        """
+        try:
+            queued = {job.path for job in self.module.reactor_bridge.call(
+                self.module.content_manager.obtain_print_jobs,
+                timeout=self.QUEUE_TIMEOUT)}
+        except ReactorTimeout:
+            # Without knowing the queue nothing can be deleted safely
+            logging.warning("Klippy is busy, can't evict uploads")
+            return 0
+        # Leave some slack for file systems with coarse timestamps
+        cutoff = min(self._active.values(), default=time.time()) - 2
+        candidates = []
+        for path, _, last_use in self.index.files():
+            if path in queued:
+                continue
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                self.index.remove(path)
+                continue
+            if st.st_mtime < cutoff:
+                if last_use is None:
+                    last_use = st.st_mtime
+                candidates.append((last_use, path))
+        candidates.sort()
+
+        freed = 0
+        for _, path in candidates:
+            if freed >= amount:
+                break
+            try:
+                st = os.stat(path)
+                os.remove(path)
+            except OSError:
+                logging.exception("Failed to evict %s", path)
+                continue
+            self.index.remove(path)
+            self.module.content_manager.remove_upload(path)
+            # Hardlinked duplicates only free space with their last link
+            if st.st_nlink == 1:
+                freed += st.st_size
+            logging.info("Evicted %s (%.1f MB) from storage",
+                    path, st.st_size / 1e6)
+        return freed
+
+
+class Reservation:
+    """
+    Space reserved for an upload by StorageManager.upload().  All bytes
+    written for the upload are added with add(), which makes room for
+    more when the reservation is exceeded.
+    """
+
+    def __init__(self, manager, length):
+        self.manager = manager
+        self.reserved = length
+        self.written = 0
+
+    def add(self, size):
+        """
+        Count size more written bytes, raise InsufficientStorage if
+        there isn't enough space for them.
+        """
+        self.written += size
+        if self.written > self.reserved:
+            self.manager._extend(self)
@@ -0,0 +1,164 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+
+class UploadIndex:
+    """
+    Index of the files uploaded into a directory by a hash of their
+    content, so that uploading the same file again doesn't create
+    another copy of it.  The index is stored as JSON in index_path.
+    It also records when each file was last used, i.e. uploaded, queued
+    or printed, see touch().
+
+    Unique names are allocated by checking the filesystem, but starting
+    from the index that was used last for the same name, so that not
+    every name before it has to be tried again.  Only the names reserved
+    for uploads in progress are kept in memory.
+    """
+
+    def __init__(self, directory, index_path):
+        self.directory = directory
+        self.index_path = index_path
+        self._lock = threading.Lock()
+        self._files = {} # path: [digest, size, last use or None]
+        self._by_digest = {} # digest: set of paths
+        # Next index to try, by name as passed to unique_path()
+        self._next_index = {}
+        # Name and index of paths returned by unique_path()
+        self._reserved = {}
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.index_path, "r") as fp:
+                files = json.load(fp)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            logging.exception("Failed to load upload index, starting empty")
+            return
+        for path, (digest, size, *last_use) in files.items():
+            if os.path.isabs(path) and isinstance(size, int):
+                # Older indexes don't have the time of last use
+                self._files[path] = [digest, size, (last_use or [None])[0]]
+                self._by_digest.setdefault(digest, set()).add(path)
+
+    def _save(self):
+        """Write the index to disk, must be called with the lock held"""
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, "w") as fp:
+            json.dump(self._files, fp)
+        os.replace(temp_path, self.index_path)
+
+    def _discard(self, path):
+        """Remove path from the index, must be called with the lock held"""
+        digest = self._files.pop(path)[0]
+        paths = self._by_digest[digest]
+        paths.discard(path)
+        if not paths:
+            del self._by_digest[digest]
+
+    def lookup(self, digest):
+        """
+        Return the path of an existing file with the given content
+        digest or None.  Entries of files that were removed or changed
+        in the meantime are dropped.
+        """
+        with self._lock:
+            changed = False
+            for path in sorted(self._by_digest.get(digest, ())):
+                try:
+                    if os.path.getsize(path) == self._files[path][1]:
+                        break
+                except OSError:
+                    pass
+                self._discard(path)
+                changed = True
+            else:
+                path = None
+            if changed:
+                self._save()
+            return path
+
+    def add(self, digest, path):
+        """Add a newly written file to the index"""
+        with self._lock:
+            if path in self._files:
+                self._discard(path)
+            self._files[path] = [digest, os.path.getsize(path), time.time()]
+            self._by_digest.setdefault(digest, set()).add(path)
+            self._reserved.pop(os.path.basename(path), None)
+            self._save()
+
+    def remove(self, path):
+        """Forget about a file that is going to be deleted"""
+        with self._lock:
+            if path in self._files:
+                self._discard(path)
+                self._save()
+
+    def touch(self, path):
+        """Record that the file at path is used now, if it is indexed"""
+        with self._lock:
+            if path in self._files:
+                self._files[path][2] = time.time()
+                self._save()
+
+    def files(self):
+        """
+        Return a list of (path, size, last use) of all indexed files.
+        The time of last use is None if it isn't known.
+        """
+        with self._lock:
+            return [(path, size, last_use) for path, (_, size, last_use)
+                    in self._files.items()]
+
+    def unique_path(self, path):
+        """
+        Reserve and return a path in the directory that doesn't exist
+        yet, based on the given path.  If /path/to/file.txt exists, this
+        returns '/path/to/file-1.txt', then '/path/to/file-2.txt' and so
+        on.  Release the path with release() if it isn't used.
+        """
+        requested = name = os.path.basename(path)
+        root, ext = os.path.splitext(name)
+        with self._lock:
+            start = index = self._next_index.get(requested, 1)
+            while (name in self._reserved
+                    or os.path.exists(os.path.join(self.directory, name))):
+                name = "{}-{}{}".format(root, index, ext)
+                index += 1
+            if index > start:
+                self._next_index[requested] = index
+            else:
+                # The requested name is free again
+                self._next_index.pop(requested, None)
+            # The index that produced name, 0 if it is the requested name
+            self._reserved[name] = (requested, index-1 if index > start else 0)
+        return os.path.join(self.directory, name)
+
+    def release(self, path):
+        """Release a path reserved by unique_path() that wasn't used"""
+        name = os.path.basename(path)
+        with self._lock:
+            requested, index = self._reserved.pop(name, (None, 0))
+            if index and self._next_index.get(requested, 0) > index:
+                self._next_index[requested] = index
+
+    @staticmethod
+    def is_same_name(path, name):
+        """
+        Whether path has the file name name, or a unique version of it
+        as returned by unique_path().
+        """
+        basename = os.path.basename(path)
+        if basename == name:
+            return True
+        root, ext = os.path.splitext(name)
+        return re.fullmatch(re.escape(root) + r"-\d+" + re.escape(ext),
+                basename) is not None
@@ -0,0 +1,120 @@
+import logging
+import os
+import time
+
+
+class UploadThrottle:
+    """
+    Limit the write bandwidth of uploads while the printer is printing.
+
+    Uploads are written to the same storage that virtual_sdcard reads the
+    current print from.  On slow SD cards the write-back of a large upload
+    can stall these reads long enough to leave marks on the print.
+    While printing, writes are therefore collected into large aligned
+    chunks which are synced to disk one at a time, dropped from the page
+    cache and spread out to not exceed PRINTING_RATE.  Otherwise files
+    are written at full speed.
+
+    is_printing is a function returning the current state, it is called
+    for every chunk and must not block.  The bytes and time of all
+    uploads are counted in metrics.
+    """
+
+    # Maximum bytes per second written while printing
+    PRINTING_RATE = 2 * 1024 * 1024
+    # Size of the chunks written at once while printing, multiple of 4096
+    CHUNK_SIZE = 1024 * 1024
+    # Whether to drop written chunks from the page cache
+    USE_FADVISE = hasattr(os, "posix_fadvise")
+
+    def __init__(self, is_printing, metrics):
+        self.is_printing = is_printing
+        self.written_bytes = metrics.counter("cura_upload_bytes_total",
+                "Bytes of print jobs written by uploads")
+        self.write_time = metrics.counter("cura_upload_seconds_total",
+                "Seconds spent writing print job uploads")
+        self.throttled_time = metrics.counter(
+                "cura_upload_throttled_seconds_total",
+                "Seconds uploads were throttled while printing")
+
+    def writer(self, fp):
+        """Return a ThrottledWriter writing to the binary file fp"""
+        return ThrottledWriter(self, fp)
+
+
+class ThrottledWriter:
+    """
+    File-like wrapper writing to fp according to an UploadThrottle.
+    Use as context manager, remaining data is written on exit and the
+    effective throughput is logged.
+    """
+
+    def __init__(self, throttle, fp):
+        self.throttle = throttle
+        self.fp = fp
+        self._chunk = bytearray()
+        self._written = 0 # Bytes passed to the file
+        self._throttled_bytes = 0 # Bytes written since throttling started
+        self._throttle_start = None # Time when throttling started
+        self._throttled_time = 0 # Seconds spent throttled in total
+        self._start = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self._flush_chunk()
+        self._stop_throttling()
+        duration = time.monotonic() - self._start
+        self.throttle.written_bytes.inc(self._written)
+        self.throttle.write_time.inc(duration)
+        self.throttle.throttled_time.inc(self._throttled_time)
+        if exc_type is None:
+            logging.info("Upload of %.1f MB written in %.1fs (%.2f MB/s), "
+                    "throttled for %.1fs", self._written / 1e6, duration,
+                    self._written / 1e6 / max(duration, 1e-6),
+                    self._throttled_time)
+
+    def write(self, data):
+        if not self.throttle.is_printing():
+            self._flush_chunk()
+            self._stop_throttling()
+            self.fp.write(data)
+            self._written += len(data)
+            return
+        if self._throttle_start is None:
+            self._throttle_start = time.monotonic()
+            self._throttled_bytes = 0
+        self._chunk += data
+        while len(self._chunk) >= self.throttle.CHUNK_SIZE:
+            with memoryview(self._chunk) as view:
+                self._write_chunk(view[:self.throttle.CHUNK_SIZE])
+            del self._chunk[:self.throttle.CHUNK_SIZE]
+
+    def _write_chunk(self, chunk):
+        """Write a chunk to disk and wait to stay below the rate"""
+        offset = self.fp.tell()
+        self.fp.write(chunk)
+        self.fp.flush()
+        fd = self.fp.fileno()
+        os.fdatasync(fd)
+        if self.throttle.USE_FADVISE:
+            os.posix_fadvise(fd, offset, len(chunk), os.POSIX_FADV_DONTNEED)
+        self._written += len(chunk)
+        self._throttled_bytes += len(chunk)
+        target = (self._throttle_start
+                + self._throttled_bytes / self.throttle.PRINTING_RATE)
+        delay = target - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _flush_chunk(self):
+        if self._chunk:
+            self._write_chunk(self._chunk)
+            self._chunk = bytearray()
+
+    def _stop_throttling(self):
+        if self._throttle_start is not None:
+            self._throttled_time += time.monotonic() - self._throttle_start
+            self._throttle_start = None